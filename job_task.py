@@ -15,15 +15,22 @@ atfork.monkeypatch_os_fork_functions()
 
 import os
 import sys
+import json
+import time
 
-from pimployee import log, setup_util, job_util
-from pimployee.switchboard_client import UnixDomainSocketClient
+from pimployee import log, setup_util, job_util, timing, zygote, pipeline, thread_slots
+from pimployee.switchboard_client import UnixDomainSocketClient, EventLoopClient, \
+     PROTOCOLS, META_CODECS, PAYLOAD_CODECS
 
 try:
     qid = os.environ["QID"]
     wid = os.environ["WID"]
-    address, port = os.environ["GATEWAY"].split(":")
-    port = int(port)
+    # host:port of a TCP gateway, or the path of a unix domain socket
+    if os.sep in os.environ["GATEWAY"]:
+        address, port = os.environ["GATEWAY"], None
+    else:
+        address, port = os.environ["GATEWAY"].split(":")
+        port = int(port)
 except Exception:
     raise Exception('environment variables QDESC/ID/GATEWAY are not set or invalid')
 
@@ -33,19 +40,40 @@ setup_util.socket_set_default_timeout(60.0)
 # that the boss has made and placed on the filesystem
 s = setup_util.connect_to_boss(address, port)
 
-# create client object for easy sending and receiving of messages
-c = UnixDomainSocketClient(s)
+# create client object for easy sending and receiving of messages.
+# the event loop client does its socket I/O on one thread instead of two
+if os.environ.get('SWITCHBOARD_CLIENT') == 'eventloop':
+    c = EventLoopClient(s)
+else:
+    c = UnixDomainSocketClient(s)
 
 c.send({
     "type": "registration",
     "qid": qid,
     "wid": wid,
+    # framings we can speak. a boss that accepts protocol 2 says so in the
+    # setup message; otherwise the legacy framing is kept
+    "protocols": PROTOCOLS,
+    "meta_codecs": sorted(META_CODECS),
+    # payloads flagged with one of these in meta['payload_codec'] are
+    # decompressed on arrival
+    "payload_codecs": PAYLOAD_CODECS,
 })
 
 m = c.read()
 if m.meta['type'] != 'setup':
     raise Exception('First message was not a setup message')
 
+# number of jobs run at once by forked children, see zygote.py
+zygote_children = m.meta.get('zygote_children', 0)
+if zygote_children > 1:
+    # logging handlers created from now on are made safe to fork
+    from atfork import stdlib_fixer
+    stdlib_fixer.fix_logging_module()
+
+# number of I/O bound jobs run at once on threads, see thread_slots.py
+thread_slot_count = m.meta.get('thread_slots', 0)
+
 # setup log
 log.setup_log(m.meta['fileno'])
 log.setup_excepthook()
@@ -57,6 +85,44 @@ setup_util.setup_sys_path(m.meta.get('ap_version'), m.meta.get('ap_path'), m.met
 
 # sets up cloud library
 setup_util.setup_cloud(m.meta['hostname'], m.meta['ap_version'])
+ap_version = m.meta['ap_version']
+job_util.ap_version = ap_version
+
+def preload(modules):
+    """Imports *modules* ahead of the first job that needs them, and tells
+    the boss how long each took, to tune the list per ap_version."""
+
+    if not modules:
+        return
+    times, errors = setup_util.preload_modules(modules)
+    log.logger.info('Preloaded %s modules in %.3fs' % (len(modules), sum(times.values())))
+    for name, error in errors.items():
+        log.logger.warning('Could not preload %s: %s' % (name, error))
+    c.send({'type': 'preload_report',
+            'ap_version': ap_version},
+           json.dumps({'import_times': times,
+                       'import_errors': errors}))
+
+preload(m.meta.get('preload'))
+
+# time the phases of every job, see timing.py
+timing.enabled = m.meta.get('phase_timing', False)
+
+# how many deserialized job functions are kept around for later jobs
+job_util.func_cache.size = m.meta.get('func_cache_size', job_util.func_cache.size)
+
+# how long a job waits for a module it needs to reach ap_path
+job_util.import_retry_deadline = m.meta.get('import_retry_deadline', job_util.import_retry_deadline)
+
+# results this large go to the boss in shared memory rather than inline
+job_util.shm_result_threshold = m.meta.get('shm_result_threshold', job_util.shm_result_threshold)
+
+# the boss may send the next assign while a job runs, to be deserialized
+# meanwhile, see pipeline.py
+pipeline_jobs = m.meta.get('pipeline', False)
+
+# bytes of outgoing messages a job may have queued before its sends block
+c.send_queue.limit = m.meta.get('send_queue_bytes', c.send_queue.limit)
 
 # save stderr descriptor, and restore on exit for atexit
 orig_stderr_fd = os.dup(sys.stderr.fileno())
@@ -67,39 +133,75 @@ message_handlers = {'stdout': setup_util.substitute_stdout_pipe,
                     'logging': setup_util.setup_logging,
                     'faulthandler': setup_util.setup_faulthandler,
                     'pilog': lambda m: log.setup_pilog(m.meta['fileno']),
+                    'preload': lambda m: preload(m.meta['modules']),
                     'assign': lambda m: None,
+                    'assign_batch': lambda m: None,
                     'die': lambda m: None}
 
-while True:
-
-    log.logger.info('Waiting for message from boss')
-
-    m = c.read()
-    handler = message_handlers.get(m.meta['type'])
-    if handler:
-        log.logger.info('Handling message %s m.meta' % m.meta)
-        handler(m)
-        log.logger.info('Done handling message %s m.meta' % m.meta)
+def restore_stderr():
+    # restore stderr for atexit to work
+    sys.stderr = sys.__stderr__
+    os.dup2(orig_stderr_fd, sys.stderr.fileno())
+
+if zygote_children > 1:
+    zygote.ZygotePool(c, zygote_children, message_handlers).run()
+    restore_stderr()
+elif thread_slot_count > 1:
+    thread_slots.ThreadSlots(c, thread_slot_count, message_handlers).run()
+    restore_stderr()
+else:
+    if pipeline_jobs:
+        # only jobs of the owner set up are deserialized ahead
+        jobs = pipeline.JobPipeline(c, job_util.prepare_job, job_util.main_waiting,
+                                    key=job_util.job_owner)
+        job_util.worker_threads.append(jobs.thread)
+        read = jobs.read
     else:
-        log.logger.info('Unrecognized message type %s' % m.meta['type'])
-
-    if m.meta['type'] == 'assign':
-        try:
-            job_util.process_job(m, c)
-            # use this to test for random crash
-            #setup_util.crash()
-        except job_util.EndProcessException:
-            log.logger.info('EndProcessException raised. Process will end')
+        read = c.read
+
+    while True:
+
+        log.logger.info('Waiting for message from boss')
+
+        if timing.enabled:
+            read_start = time.time()
+            m = read()
+            timing.record('idle', time.time() - read_start)
+        else:
+            m = read()
+        handler = message_handlers.get(m.meta['type'])
+        if handler:
+            log.logger.info('Handling message %s m.meta' % m.meta)
+            handler(m)
+            log.logger.info('Done handling message %s m.meta' % m.meta)
+        else:
+            log.logger.info('Unrecognized message type %s' % m.meta['type'])
+
+        if m.meta['type'] in job_util.job_processors:
+            try:
+                job_util.job_processors[m.meta['type']](m, c)
+                # use this to test for random crash
+                #setup_util.crash()
+            except job_util.EndProcessException:
+                log.logger.info('EndProcessException raised. Process will end')
+                if pipeline_jobs:
+                    # the boss can assign those read ahead elsewhere
+                    jids = [jid for ahead in jobs.drain()
+                            if ahead.meta['type'] in job_util.job_processors
+                            for jid in job_util.job_jids(ahead)]
+                    if jids:
+                        c.send({'type': 'batch_aborted',
+                                'jids': jids})
+                        # kill below may drop what is still queued
+                        c.close()
+                break
+
+        if m.meta['type'] == 'die':
+            log.logger.info('Received message to die.')
+            if timing.enabled:
+                log.logger.info('Phase timings over worker lifetime %s' % timing.lifetime_report())
+            restore_stderr()
             break
-
-    if m.meta['type'] == 'die':
-        log.logger.info('Received message to die.')
-
-        # restore stderr for atexit to work
-        sys.stderr = sys.__stderr__
-        os.dup2(orig_stderr_fd, sys.stderr.fileno())
-
-        break
 c.kill()
 # an interpreter shutdown sometimes crashes. we don't want faulthandler
 # to deal with it
@@ -0,0 +1,79 @@
+"""
+Per-job resource accounting. A snapshot is taken when a job starts, and the
+difference at the end goes out with the finished message, to tell CPU-bound
+jobs from I/O-bound ones and to right-size core types.
+"""
+
+import resource
+import threading
+
+import atfork
+
+# threads and processes started in this process so far. processes are
+# counted by the atfork parent hook, which covers os.fork and subprocess.
+_started = {'threads': 0, 'processes': 0}
+
+def _count_process():
+    _started['processes'] += 1
+
+atfork.atfork(parent=_count_process)
+
+_orig_start_new_thread = threading._start_new_thread
+
+def _start_new_thread(function, args, kwargs={}):
+    _started['threads'] += 1
+    return _orig_start_new_thread(function, args, kwargs)
+
+# every threading.Thread is started through this
+threading._start_new_thread = _start_new_thread
+
+def _read_proc_io():
+    """Returns the I/O counters of /proc/self/io, or {} where the file is
+    missing or unreadable, as in some containers."""
+
+    try:
+        with open('/proc/self/io') as f:
+            return dict((key, int(value)) for key, value in
+                        (line.split(':') for line in f if ':' in line))
+    except (IOError, ValueError):
+        return {}
+
+def snapshot():
+    return {'self': resource.getrusage(resource.RUSAGE_SELF),
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN),
+            'io': _read_proc_io(),
+            'started': dict(_started)}
+
+def report(before):
+    """Returns the resources used since the *before* snapshot. Times are
+    seconds, rss is KB. Children are the processes spawned and waited for
+    in the meantime."""
+
+    after = snapshot()
+
+    usage = {}
+    for key, field in (('user_cpu', 'ru_utime'),
+                       ('sys_cpu', 'ru_stime'),
+                       ('minor_faults', 'ru_minflt'),
+                       ('major_faults', 'ru_majflt'),
+                       ('voluntary_switches', 'ru_nvcsw'),
+                       ('involuntary_switches', 'ru_nivcsw')):
+        usage[key] = getattr(after['self'], field) - getattr(before['self'], field)
+        usage['children_' + key] = getattr(after['children'], field) - getattr(before['children'], field)
+
+    usage['max_rss'] = after['self'].ru_maxrss
+    usage['max_rss_delta'] = after['self'].ru_maxrss - before['self'].ru_maxrss
+    usage['children_max_rss'] = after['children'].ru_maxrss
+
+    # read_bytes/write_bytes hit storage, rchar/wchar include pipes and sockets
+    for key, field in (('read_bytes', 'read_bytes'),
+                       ('write_bytes', 'write_bytes'),
+                       ('read_chars', 'rchar'),
+                       ('write_chars', 'wchar')):
+        if field in after['io'] and field in before['io']:
+            usage[key] = after['io'][field] - before['io'][field]
+
+    usage['threads_spawned'] = after['started']['threads'] - before['started']['threads']
+    usage['processes_spawned'] = after['started']['processes'] - before['started']['processes']
+
+    return usage
@@ -0,0 +1,110 @@
+"""
+Waits for a module that failed to import to show up on sys.path.
+
+Jobs often reference modules that users pushed to ap_path moments ago and
+that have not reached this worker yet. Rather than sleeping a fixed time
+between retries, a ModuleWatch stats the directories the module would be
+created in, and returns as soon as one of them changes. It also returns
+every RETRY_INTERVAL seconds regardless, for modules imported in ways it
+cannot tell where from.
+
+ap_path lives on a network filesystem, where inotify does not see changes
+made by other hosts, so the directories are polled.
+"""
+
+import os
+import re
+import sys
+import imp
+import time
+import pickletools
+from cStringIO import StringIO
+
+# seconds between polls of the watched directories
+POLL_INTERVAL = 0.01
+# seconds after which to retry anyway, no change seen
+RETRY_INTERVAL = 0.25
+
+_missing_re = re.compile(r'No module named (\S+)')
+
+def missing_module(error, pickled=None):
+    """The dotted module name an ImportError complains about, if any.
+    Python 2 only names the part of a dotted name it did not find, so for
+    an error unpickling *pickled* the rest is taken from the pickle."""
+
+    match = _missing_re.search(str(error))
+    if not match:
+        return None
+    name = match.group(1)
+    if '.' not in name and pickled is not None:
+        name = _pickled_module(pickled, name) or name
+    return name
+
+def _pickled_module(pickled, part):
+    """The dotted name of a module referred to in *pickled* up to *part*,
+    where *part* is not its top level, or None"""
+
+    try:
+        for opcode, arg, pos in pickletools.genops(StringIO(pickled)):
+            if opcode.name == 'GLOBAL':
+                parts = arg.split(' ')[0].split('.')
+                if part in parts[1:]:
+                    return '.'.join(parts[:parts.index(part, 1) + 1])
+    except Exception:
+        # a pickle that does not parse to the end may still name it first
+        pass
+    return None
+
+def invalidate_caches():
+    """Forgets the sys.path entries that did not exist when first imported
+    from, so that a directory created since is searched."""
+
+    for path, importer in sys.path_importer_cache.items():
+        if isinstance(importer, imp.NullImporter):
+            del sys.path_importer_cache[path]
+
+class ModuleWatch(object):
+    """Watches the sys.path roots, and for a dotted *name* the directories
+    of its parent packages, for entries being created or removed."""
+
+    def __init__(self, name=None):
+        self.name = name
+        self._mtimes = self._snapshot()
+
+    def _directories(self):
+        roots = [path or os.getcwd() for path in sys.path if isinstance(path, basestring)]
+        directories = list(roots)
+
+        if self.name and '.' in self.name:
+            parts = self.name.split('.')
+            for i in range(1, len(parts)):
+                package = sys.modules.get('.'.join(parts[:i]))
+                directories.extend(getattr(package, '__path__', None) or [])
+            # the top-level package may exist without having been imported
+            directories.extend(os.path.join(root, parts[0]) for root in roots)
+
+        return directories
+
+    def _snapshot(self):
+        mtimes = {}
+        for directory in self._directories():
+            try:
+                mtimes[directory] = os.stat(directory).st_mtime
+            except OSError:
+                mtimes[directory] = None
+        return mtimes
+
+    def wait(self, deadline):
+        """Returns True once a watched directory changed since the last
+        call, or once RETRY_INTERVAL passed, or False if time.time() passes
+        *deadline* first."""
+
+        retry_at = time.time() + RETRY_INTERVAL
+        while time.time() < deadline:
+            mtimes = self._snapshot()
+            if mtimes != self._mtimes or time.time() >= retry_at:
+                self._mtimes = mtimes
+                invalidate_caches()
+                return True
+            time.sleep(min(POLL_INTERVAL, max(deadline - time.time(), 0)))
+        return False
@@ -1,21 +1,39 @@
 import os
 import sys
 import time
-import random
 import signal
+import tempfile
+import hashlib
+import functools
 import marshal
 import resource
 import threading
 import traceback
+import collections
 
 import cProfile
+import zlib
+import json
 import cPickle as pickle
+from cStringIO import StringIO
 
 import log
+import timing
+import accounting
+import shm
+import import_wait
+import sampling_profiler
+from prefetch import PrefetchingReader, ResultPrefetcher
 
 class EndProcessException(Exception):
     pass
 
+# RLIMIT_NPROC counts every process and thread of the user, not just those
+# of one job. where jobs run side by side, as in a zygote, the budget is
+# scaled by how many run at once, plus the tasks of the worker itself
+nproc_jobs = 1
+nproc_reserved = 0
+
 def restrict_resources(core_type, cores):
     """Restrict the number of processes that a user can have running.
     Prevents fork bombing."""
@@ -24,27 +42,104 @@ def restrict_resources(core_type, cores):
              'c2': 200,
              'f2': 300,
              'm1': 300,
-             's1': 50}.get(core_type, 100) * cores
+             's1': 50}.get(core_type, 100) * cores * nproc_jobs + nproc_reserved
 
     log.logger.info('Restricting (%s, %s) to %s procs', core_type, cores, nproc)
 
     # set max number of processes to prevent fork bombs
     resource.setrlimit(resource.RLIMIT_NPROC, (nproc, nproc))
 
+class FuncCache(object):
+    """Deserialized functions of recent jobs, keyed by a hash of their
+    pickle. Map-style workloads send the same function in thousands of
+    consecutive jobs, and unpickling it every time re-imports modules and
+    rebuilds closures."""
+
+    def __init__(self, size=32):
+        # a size of 0 disables the cache
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._funcs = collections.OrderedDict()
+        self._context = None
+        # a JobPipeline deserializes the next job while a batch may be
+        # deserializing its own
+        self._lock = threading.Lock()
+
+    def deserialize(self, s, context):
+        """Returns the function pickled in *s*. The cache is emptied whenever
+        *context* differs from the one of the previous call."""
+
+        with self._lock:
+            return self._deserialize(s, context)
+
+    def _deserialize(self, s, context):
+        if context != self._context:
+            self._funcs.clear()
+            self._context = context
+
+        if self.size <= 0:
+            return deserialize(s)
+
+        key = hashlib.sha1(s).hexdigest()
+        if key in self._funcs:
+            self.hits += 1
+            func = self._funcs.pop(key)
+        else:
+            self.misses += 1
+            func = deserialize(s)
+
+        # most recently used last, evict from the front
+        self._funcs[key] = func
+        while len(self._funcs) > self.size:
+            self._funcs.popitem(last=False)
+
+        return func
+
+    def report(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+func_cache = FuncCache()
+
+# ap_version from the setup message, part of the func cache's context. the
+# packages are set up once per worker, so an assign carries none, but one
+# that does is keyed by its own
+ap_version = None
+
+# state of the job running on the current thread. thread_slots.py runs
+# several jobs at once, and sets job_local.slot on each of their threads,
+# along with job_local.killable, which run_job calls with the jid of the
+# job once it may be killed and with None once it may not. job_local.stats
+# holds figures the job adds to its report, such as its prefetch stats
+job_local = threading.local()
+
+# threads of the worker itself that outlive jobs, besides the client's
+worker_threads = []
+
+# set while the job loop waits, for a message or on a job's func. a
+# JobPipeline prepares the next job only then, as unpickling holds the GIL
+# throughout and would hold up the start of a job
+main_waiting = threading.Event()
+
+# serialized results of at least this many bytes are passed to the boss as
+# a memory backed file, if the boss link can carry descriptors. None sends
+# every result inline
+shm_result_threshold = None
+
+# set traceback max to 1M characters
+# we've had tracebacks that exceed Mongo's limit of 16 MB,
+# which causes the job outputs to go unsaved.
+traceback_max_length = 1000000
+
 def process_job(m, c):
     """Processes a job from an assign message"""
 
     import scicloud as cloud
 
-    restrict_resources(m.meta.get('core_type', 'c1'), m.meta.get('cores', 1))
-
-    # set traceback max to 1M characters
-    # we've had tracebacks that exceed Mongo's limit of 16 MB,
-    # which causes the job outputs to go unsaved.
-    traceback_max_length = 1000000
+    timer = timing.PhaseTimer(m.received_at)
+    timer.mark('queue_wait')
 
-    end_process = False
-    process_id = os.getpid()
+    restrict_resources(m.meta.get('core_type', 'c1'), m.meta.get('cores', 1))
 
     log.logger.info('Assigned job %s' % m.meta['jid'])
 
@@ -53,24 +148,146 @@ def process_job(m, c):
 
     log.logger.info('Getting func, args, kwargs from payload -- not deserializing yet')
 
+    # views into the received or mapped payload; nothing is copied until
+    # unpickling
+    func, args, kwargs = m.payload_parts()
+
     log.logger.info('payload length %s payload parts %s' % (len(m.payload), m.meta['payload_parts']))
 
-    func = m.payload[:m.meta['payload_parts'][0]]
-    args = m.payload[m.meta['payload_parts'][0]:sum(m.meta['payload_parts'])]
-    kwargs = m.payload[sum(m.meta['payload_parts']):]
+    setup_job_owner(cloud, m.meta)
+    timer.mark('owner_setup')
+
+    log.logger.info('Deserializing func, args, kwargs')
+
+    # start timing from deserialization
+    start_time = time.time()
+
+    try:
+        if getattr(m, 'prepared', None):
+            # deserialized by a JobPipeline while the previous job ran
+            func, args, kwargs = m.prepared
+        else:
+            func = deserialize_func(func, m.meta)
+            args = deserialize(args) if args else ()
+            kwargs = deserialize(kwargs) if kwargs else {}
+    except:
+        #FIXME # commented this out # log.pilogger.exception('Could not depickle job')
+        tb = traceback.format_exc()[:traceback_max_length]
+
+        c.send({'type': 'finished',
+                'runtime': time.time() - start_time,
+                'traceback': True},
+               tb)
+
+        # raise an exception to signal that the process should be killed
+        return #FIXME # commented this out # raise EndProcessException('Could not depickle. Signal to kill process.')
+
+    timer.mark('deserialize')
+
+    if run_job(m.meta, c, func, args, kwargs, start_time, timer=timer):
+        raise EndProcessException('Process should be ended')
+
+def prepare_job(m):
+    """Deserializes the func, args and kwargs of an assign message ahead of
+    time into m.prepared, for a JobPipeline. If that fails nothing is kept,
+    and process_job deserializes again when the job starts. The error is
+    then reported for that job just as without the pipeline, and modules
+    that jobs before it created are found."""
+
+    try:
+        func, args, kwargs = m.payload_parts()
+        m.prepared = (deserialize_func(func, m.meta),
+                      deserialize(args) if args else (),
+                      deserialize(kwargs) if kwargs else {})
+    except:
+        log.logger.info('Could not deserialize job %s ahead, retrying when it starts' % m.meta.get('jid'))
+
+def process_job_batch(m, c):
+    """Processes the jobs of an assign_batch message back to back.
+
+    The jobs share the func, owner and settings of the batch meta, and
+    meta['jobs'] lists a dict with the 'jid' of each. The payload is laid
+    out as func, then args and kwargs of every job in order, with
+    meta['payload_parts'] holding every length but the last. Each job gets
+    its own processing and finished messages, tagged with its jid, so a
+    failing job does not affect the others."""
+
+    import scicloud as cloud
+
+    restrict_resources(m.meta.get('core_type', 'c1'), m.meta.get('cores', 1))
+
+    jobs = m.meta['jobs']
+    log.logger.info('Assigned batch of %s jobs' % len(jobs))
+
+    parts = m.payload_parts()
+
+    setup_job_owner(cloud, m.meta)
+
+    for i, job in enumerate(jobs):
+        tag = {'jid': job['jid']}
+        # jobs after the first were not waiting in the queue
+        timer = timing.PhaseTimer(m.received_at if i == 0 else None)
+        timer.mark('queue_wait')
+
+        log.logger.info('Starting job %s of batch' % job['jid'])
+        c.send(dict(tag, type='processing'))
+
+        start_time = time.time()
+
+        try:
+            # after the first job, the func comes out of the func cache
+            func = deserialize_func(parts[0], m.meta)
+            args = deserialize(parts[1 + 2 * i]) if parts[1 + 2 * i] else ()
+            kwargs = deserialize(parts[2 + 2 * i]) if parts[2 + 2 * i] else {}
+        except:
+            tb = traceback.format_exc()[:traceback_max_length]
+
+            c.send(dict(tag,
+                        type='finished',
+                        runtime=time.time() - start_time,
+                        traceback=True),
+                   tb)
+            continue
+
+        timer.mark('deserialize')
+
+        if run_job(m.meta, c, func, args, kwargs, start_time, tag, timer):
+            # the rest of the batch was never started
+            c.send({'type': 'batch_aborted',
+                    'jids': [job['jid'] for job in jobs[i + 1:]]})
+            raise EndProcessException('Process should be ended')
+
+job_processors = {'assign': process_job,
+                  'assign_batch': process_job_batch}
+
+def job_jids(m):
+    """The jids of the jobs in an assign or assign_batch message"""
+
+    if m.meta['type'] == 'assign_batch':
+        return [job['jid'] for job in m.meta['jobs']]
+    return [m.meta['jid']]
+
+def job_owner(m):
+    """What jobs of the same owner share: the cloud client config that
+    setup_job_owner makes from the meta of message *m*, parent jid too"""
+
+    return (m.meta['api_key'], m.meta['api_secretkey'], m.meta['server_url'], m.meta['ujid'])
+
+def setup_job_owner(cloud, meta):
+    """Configures the cloud client with the credentials of the job owner"""
 
     log.logger.info('Configuring cloud client for job owner')
 
-    if m.meta['ujid']:
+    if meta['ujid']:
         # this only happens if the job has a ujid assigned already
         # otherwise, if the ujid isn't there, the parent relationship
         # will not be accurately recorded
-        cloud.config.parent_jid = m.meta['ujid']
+        cloud.config.parent_jid = meta['ujid']
 
-    cloud.config.api_key = m.meta['api_key']
-    cloud.config.api_secretkey = m.meta['api_secretkey']
+    cloud.config.api_key = meta['api_key']
+    cloud.config.api_secretkey = meta['api_secretkey']
 
-    cloud.config.url = m.meta['server_url']
+    cloud.config.url = meta['server_url']
     cloud.config.commit()
 
     # at this point, a new process where picloud is being used,
@@ -79,49 +296,84 @@ def process_job(m, c):
     cloud.cloudconfig.flush_config()
 
     # configures cloud to user's api/secret key. Sets it immutable
-    cloud.setkey(int(m.meta['api_key']),
-                 m.meta['api_secretkey'],
-                 server_url=m.meta['server_url'],
+    cloud.setkey(int(meta['api_key']),
+                 meta['api_secretkey'],
+                 server_url=meta['server_url'],
                  immutable=True)
 
-    log.logger.info('Deserializing func, args, kwargs')
+def deserialize_func(s, meta):
+    if meta['job_type'] in ('filemap_mapper', 'filemap_reducer'):
+        # filemap funcs are wrappers that get called to build the job,
+        # so every job needs a fresh one
+        return deserialize(s)
 
-    # start timing from deserialization
-    start_time = time.time()
+    # a cached func must not outlive the owner or packages it was
+    # unpickled with
+    return func_cache.deserialize(s, (meta['api_key'], meta.get('ap_version', ap_version)))
 
-    try:
-        func = deserialize(func)
-        args = deserialize(args) if args else ()
-        kwargs = deserialize(kwargs) if kwargs else {}
-    except:
-        #FIXME # commented this out # log.pilogger.exception('Could not depickle job')
-        tb = traceback.format_exc()[:traceback_max_length]
+def run_job(meta, c, func, args, kwargs, start_time, tag=None, timer=None):
+    """Runs a deserialized job and sends its finished message, plus its
+    profile if asked for. *tag* is added to every message sent. *timer*
+    is the job's PhaseTimer. Returns whether the process should be ended
+    afterwards."""
 
-        c.send({'type': 'finished',
-                'runtime': time.time() - start_time,
-                'traceback': True},
-               tb)
+    import scicloud as cloud
 
-        # raise an exception to signal that the process should be killed
-        return #FIXME # commented this out # raise EndProcessException('Could not depickle. Signal to kill process.')
+    tag = tag or {}
+    timer = timer or timing.PhaseTimer()
+    end_process = False
+    process_id = os.getpid()
+    # the thread slot running the job, if any. signals, forks and the cloud
+    # client are process wide, so jobs in slots leave them alone
+    slot = getattr(job_local, 'slot', None)
+    killable = getattr(job_local, 'killable', None) or (lambda jid: None)
 
-    # catch SIGTERM (kill commands) and simply raise an exception
-    # so that we get access to the traceback
-    signal.signal(signal.SIGTERM, sigterm_handler)
+    if slot is None:
+        # catch SIGTERM (kill commands) and simply raise an exception
+        # so that we get access to the traceback
+        signal.signal(signal.SIGTERM, sigterm_handler)
 
     serialized_result = None
+    result_chunks = None
     exception_traceback = None
+    profiler = None
 
-    try:
+    usage_before = accounting.snapshot()
+    job_local.stats = {}
 
-        if m.meta['job_type'] == 'filemap_mapper':
-            func = func(mapper_combiner_generator)
-        elif m.meta['job_type'] == 'filemap_reducer':
+    try:
+        # only while user code runs, so the finished message goes out
+        killable(tag.get('jid', meta.get('jid')))
+
+        if meta['job_type'] == 'filemap_mapper':
+            options = {}
+            if meta.get('stream_mapper'):
+                options['output'] = MapperOutput(c, meta, tag)
+            if meta.get('prefetch'):
+                options['prefetch'] = (meta.get('prefetch_block_size', 1048576),
+                                       meta.get('prefetch_depth', 4))
+            if meta.get('split_mapper') and meta.get('cores', 1) > 1 and slot is None:
+                options['split'] = (meta['cores'], functools.partial(result_pickler, meta))
+            func = func(functools.partial(mapper_combiner_generator, **options))
+        elif meta['job_type'] == 'filemap_reducer' and meta.get('reducer_concurrency', 1) > 1:
+            func = func(functools.partial(reducer_generator,
+                                          prefetch=(meta['reducer_concurrency'],
+                                                    meta.get('reducer_window'),
+                                                    meta.get('reducer_ordered', True))))
+        elif meta['job_type'] == 'filemap_reducer':
             func = func(reducer_generator)
 
         log.logger.info('Executing job')
 
-        if m.meta['profile']:
+        main_waiting.set()
+        if meta['profile'] and meta.get('profile_mode') == 'sampling' and slot is None:
+            profiler = sampling_profiler.SamplingProfiler(meta.get('profile_interval', 0.01))
+            profiler.start()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                profiler.stop()
+        elif meta['profile']:
             f_globals = {'__builtins__': globals()['__builtins__'],
                          '__name__': '__main__',
                          '__doc__': None,
@@ -133,22 +385,37 @@ def process_job(m, c):
             result = f_locals['result']
         else:
             result = func(*args, **kwargs)
+        timer.mark('call')
         #time.sleep(100)
-        # serialize the result
-        adapter = getattr(cloud,'__cloud').adapter
-        serialized_obj = adapter.getserializer(m.meta['fast_serialization'])(result)
+        if isinstance(result, MapperOutput):
+            # sent while the mapper ran
+            result_chunks = result.close()
+            timer.mark('serialize')
+        elif meta.get('stream_result'):
+            # no size limit applies, as the result is never in one frame
+            result_chunks = stream_result(c, meta, result, tag)
+            timer.mark('serialize')
+        else:
+            # serialize the result
+            adapter = getattr(cloud,'__cloud').adapter
+            serialized_obj = adapter.getserializer(meta['fast_serialization'])(result)
 
-        # TODO: Generate report somewhere?
-        serialized_obj.run_serialization()
+            # TODO: Generate report somewhere?
+            serialized_obj.run_serialization()
+            timer.mark('serialize')
 
-        adapter.check_size(serialized_obj, None, True, 128000000)
+            adapter.check_size(serialized_obj, None, True, 128000000)
+            timer.mark('check_size')
 
-        serialized_result = serialized_obj.serializedObject
+            serialized_result = serialized_obj.serializedObject
 
         log.logger.info('Successfully executed job.')
+        killable(None)
 
     except BaseException as e:
+        killable(None)
 
+        timer.mark('exception')
         log.logger.exception('Executing job hit exception')
 
         # extract traceback to see exception stack and details
@@ -159,69 +426,262 @@ def process_job(m, c):
 
     finally:
 
+        main_waiting.clear()
+
         # immediately exit if this is a fork of the original process
         if process_id != os.getpid():
             sys.exit(0)
 
-        # set signal handler back to default
-        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        # the slots check once no job of the owner is left running
+        if slot is None:
+            # set signal handler back to default
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
-        # closes threads
-        cloud_open, cloud_mp_open = cloud.close(), cloud.mp.close()
-        log.logger.info('Closed cloud and cloud.mp. Open check (cloud=%s, cloud.mp=%s)' % (cloud_open, cloud_mp_open))
+            # closes threads
+            close_cloud(cloud)
+            timer.mark('cloud_close')
 
-        if not end_process:
-            running_threads = [ th for th in threading.enumerate()[1:] if th not in (c._sender, c._receiver) ]
-            if running_threads:
-                time.sleep(0.02) #give some time for threads that may be shutting down
-                running_threads = [ th for th in threading.enumerate()[1:] if th not in (c._sender, c._receiver) ]
+            if not end_process and user_threads_running(c):
+                end_process = True
 
-                if running_threads:
-                    end_process = True
-                    log.logger.info('Users threads %s did not terminate' % repr(running_threads))
-                    log.pilogger.info('Cannot use persistent process due to following thread(s) still running:\n%s\n' % repr(running_threads))
+            timer.mark('thread_check')
 
         runtime = time.time() - start_time
+        resources = accounting.report(usage_before)
 
     # flush stdout and stderr
     sys.stdout.flush()
     sys.stderr.flush()
 
-    if m.meta['profile']:
+    if isinstance(profiler, sampling_profiler.SamplingProfiler):
+        c.send(dict(tag,
+                    type='profile',
+                    profile_mode='sampling',
+                    format='collapsed',
+                    encoding='zlib',
+                    samples=profiler.samples,
+                    interval=profiler.interval),
+               zlib.compress(profiler.collapsed()))
+    elif profiler:
         profiler.create_stats()
-        c.send({'type': 'profile'},
+        c.send(dict(tag, type='profile'),
                 marshal.dumps(profiler.stats))
 
-    if serialized_result:
-        c.send({'type': 'finished',
-                'runtime': runtime},
-               serialized_result)
+    timer.mark('send')
+
+    finished = dict(tag,
+                    type='finished',
+                    runtime=runtime,
+                    func_cache=func_cache.report())
+
+    result_fd = None
+    if (serialized_result and shm_result_threshold is not None and
+            len(serialized_result) >= shm_result_threshold and c.passes_fds):
+        try:
+            result_fd = shm.write('result', serialized_result)
+        except (OSError, IOError):
+            log.logger.exception('Could not write result to shared memory, sending it inline')
+
+    payload = None
+    if result_fd is not None:
+        # the boss reads the result from the descriptor
+        finished.update(result_fd=True, result_length=len(serialized_result))
+    elif serialized_result:
+        payload = serialized_result
+    elif result_chunks is not None:
+        # the result went out ahead in result_chunk messages
+        finished['chunks'] = result_chunks
     elif exception_traceback:
-        c.send({'type': 'finished',
-                'runtime': runtime,
-                'traceback': True},
-               exception_traceback)
+        finished['traceback'] = True
+        payload = exception_traceback
+
+    report = {'compression': c.compression_report(),
+              'send_queue': c.send_queue.report(),
+              'resources': resources}
+    report.update(job_local.stats)
+    if slot is not None:
+        # resources then include the jobs in the other slots
+        report['thread_slot'] = slot
+    if timing.enabled:
+        report['phases'] = timer.phases
+        report['phase_histograms'] = timing.lifetime_report()
+
+    # checked as it is framed, has_fd included
+    framed = dict(finished, **report)
+    if result_fd is not None:
+        framed['has_fd'] = True
+    if c.meta_fits(framed):
+        finished.update(report)
+    else:
+        # too big for a legacy meta block, so it goes just ahead instead
+        c.send(dict(tag, type='job_report'),
+               json.dumps(report))
+
+    if result_fd is not None:
+        c.send(finished,
+               fileno=result_fd,
+               callback=lambda: os.close(result_fd))
+    elif payload is not None or result_chunks is not None:
+        c.send(finished,
+               payload)
     else:
         log.logger.error('Critical error: No result and no traceback.')
 
-    if end_process:
-        raise EndProcessException('Process should be ended')
-
+    timer.mark('finished_send')
+    timer.finish()
+
+    return end_process
+
+
+class ResultChunkWriter(object):
+    """File-like object that sends what is written to it as result_chunk
+    messages of about *chunk_size* bytes. Writing blocks while
+    *max_pending* chunks are still waiting to be sent, so a slow boss link
+    holds back the pickler instead of growing the send queue."""
+
+    def __init__(self, c, tag, chunk_size, max_pending):
+        self._c = c
+        self._tag = tag
+        self._chunk_size = chunk_size
+        self._pending = threading.Semaphore(max_pending)
+        self._pieces = []
+        self._size = 0
+        self.chunks = 0
+
+    def write(self, data):
+        self._pieces.append(data)
+        self._size += len(data)
+        if self._size >= self._chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self._size:
+            return
+        self._pending.acquire()
+        self._c.send(dict(self._tag, type='result_chunk', index=self.chunks),
+                     ''.join(self._pieces),
+                     callback=self._pending.release)
+        self.chunks += 1
+        self._pieces = []
+        self._size = 0
+
+def result_chunk_writer(c, meta, tag):
+    return ResultChunkWriter(c, tag,
+                             meta.get('result_chunk_size', 4000000),
+                             meta.get('result_chunks_pending', 4))
+
+def result_pickler(meta, f):
+    if meta['fast_serialization'] == 2:
+        # plain cPickle, same as scicloud's fastest serializer
+        return pickle.Pickler(f, 2)
+    else:
+        from scicloud.serialization import cloudpickle
+        return cloudpickle.CloudPickler(f, 2)
+
+def stream_result(c, meta, result, tag):
+    """Pickles *result* straight into result_chunk messages, so that the
+    serialized result is never held in memory whole. The chunks only make
+    up a result if a finished message without a traceback follows them.
+    Returns the number of chunks sent."""
+
+    writer = result_chunk_writer(c, meta, tag)
+    result_pickler(meta, writer).dump(result)
+    writer.flush()
+
+    return writer.chunks
+
+class MapperOutput(object):
+    """Output of a mapper job with stream_mapper set. Items are pickled in
+    batches of *mapper_batch_size* as they come, and sent in result_chunk
+    messages, so the mapper runs in constant memory. The chunks unpickle to
+    the same list that the mapper would otherwise return."""
+
+    # what protocol 2 picklers write ahead of the items of a list that is
+    # the first object they memoize, up to the memo index
+    LIST_HEAD = '\x80\x02]q'
+    STOP = '.'
+
+    def __init__(self, c, meta, tag):
+        self._meta = meta
+        self._batch_size = meta.get('mapper_batch_size', 1000)
+        self._batch = []
+        self._writer = result_chunk_writer(c, meta, tag)
+        # the list the batches append to
+        self._writer.write('\x80\x02]')
+
+    def extend(self, items):
+        for item in items:
+            self._batch.append(item)
+            if len(self._batch) >= self._batch_size:
+                self._flush_batch()
+
+    def _flush_batch(self):
+        if not self._batch:
+            return
+
+        # each batch is pickled as a list of its own, of which only the
+        # appends are kept. memo entries the batch puts are only referred
+        # to by the batch itself
+        f = StringIO()
+        result_pickler(self._meta, f).dump(self._batch)
+        pickled = f.getvalue()
+        if not pickled.startswith(self.LIST_HEAD) or not pickled.endswith(self.STOP):
+            raise Exception('Unexpected pickle of mapper output batch')
+
+        self._writer.write(pickled[len(self.LIST_HEAD) + 1:-len(self.STOP)])
+        self._batch = []
+
+    def close(self):
+        """Sends what is left. Returns the number of chunks sent."""
+
+        self._flush_batch()
+        self._writer.write(self.STOP)
+        self._writer.flush()
+        return self._writer.chunks
+
+# seconds to wait for a module missing from a pickle to appear, as it may
+# have just been pushed to ap_path
+import_retry_deadline = 2.0
 
 def deserialize(s):
-    get_func_end_time = None
+    watch = None
 
     while True:
         try:
-            return pickle.loads(s)
-            break
-        except ImportError:
-            if not get_func_end_time:
-                get_func_end_time = time.time() + 2.0
-            elif time.time() > get_func_end_time:
+            # cStringIO reads buffers (memoryviews of the payload) in place
+            return pickle.load(StringIO(s))
+        except ImportError, e:
+            if watch is None:
+                deadline = time.time() + import_retry_deadline
+                watch = import_wait.ModuleWatch(import_wait.missing_module(e, s))
+                # the module may have appeared before the watch began
+                import_wait.invalidate_caches()
+            elif not watch.wait(deadline):
                 raise
-            log.logger.info('Could not deserialize, retrying...')
-            time.sleep(random.random())
+            log.logger.info('Could not deserialize, missing %s. retrying...' % watch.name)
+
+def close_cloud(cloud):
+    """Closes the threads of the cloud client"""
+
+    cloud_open, cloud_mp_open = cloud.close(), cloud.mp.close()
+    log.logger.info('Closed cloud and cloud.mp. Open check (cloud=%s, cloud.mp=%s)' % (cloud_open, cloud_mp_open))
+
+def user_threads_running(c):
+    """Whether threads that jobs started are still running, besides those of
+    the client *c* and the worker itself. If so, the process cannot be
+    reused."""
+
+    own_threads = c.threads() + tuple(worker_threads)
+    running_threads = [ th for th in threading.enumerate()[1:] if th not in own_threads ]
+    if running_threads:
+        time.sleep(0.02) #give some time for threads that may be shutting down
+        running_threads = [ th for th in threading.enumerate()[1:] if th not in own_threads ]
+
+        if running_threads:
+            log.logger.info('Users threads %s did not terminate' % repr(running_threads))
+            log.pilogger.info('Cannot use persistent process due to following thread(s) still running:\n%s\n' % repr(running_threads))
+            return True
+    return False
 
 def sigterm_handler(signum, frame):
     log.logger.info('Signal handler called with signal %s' % signum)
@@ -231,10 +691,61 @@ def sigterm_handler(signum, frame):
 import itertools
 import __builtin__
 
-def mapper_combiner_generator( mapper, file_name, file_size, record_reader, combiner):
+def mapper_combiner_generator( mapper, file_name, file_size, record_reader, combiner, output=None,
+                               prefetch=None, getf=None, split=None):
+    """Returns the function a filemap mapper job runs. It returns the
+    combined output as a list, or if *output* is a MapperOutput, extends
+    that and returns it. With *prefetch* a (block size, depth) pair, the
+    file is read ahead by a PrefetchingReader. *getf* opens the file, by
+    default cloud.files.getf. With *split* a (processes, new_pickler)
+    pair, the byte range is mapped by that many forked children, see
+    split_map."""
+
     import scicloud as cloud
     import types
 
+    def map_range(start_byte, end_byte, sink):
+        """Maps the records of a byte range into *sink*, or into a list that
+        is returned if *sink* is None."""
+
+        fobj = (getf or cloud.files.getf)(file_name, start_byte, file_size)
+        if prefetch:
+            fobj = PrefetchingReader(fobj, *prefetch)
+
+        try:
+            rr_it = record_reader(fobj, end_byte)
+            if type(rr_it) != types.GeneratorType:
+                raise Exception('record_reader is not a generator')
+
+            if hasattr(itertools.chain, 'from_iterable'):  #Python2.6+
+                map_results_it = itertools.chain.from_iterable( itertools.imap(mapper, rr_it) )
+            else:
+                map_results_it = ( map_result for map_result in itertools.imap(mapper, rr_it) )
+
+            comb = combiner(map_results_it)
+            if type(comb) != types.GeneratorType:
+                raise Exception('combiner is not a generator')
+
+            try:
+                if sink is not None:
+                    sink.extend(comb)
+                    result = sink
+                else:
+                    result = __builtin__.list( comb )
+            except Exception as e:
+                if e.message.find("is not iterable") > 0 :
+                    msg = e.message + "\n\nThis could be an issue with the mapper function not returning an iterable.\nPlease make sure that the mapper() is either a generator object or returns an iteratable."
+                    raise Exception(msg)
+                else:
+                    raise e
+        finally:
+            # also stops the prefetching thread if the mapper failed
+            fobj.close()
+            if prefetch:
+                job_local.stats['prefetch'] = fobj.stats()
+
+        return result
+
     def inner(start_byte, end_byte):
 
         log.logger.info('mapper function attr')
@@ -245,56 +756,140 @@ def mapper_combiner_generator( mapper, file_name, file_size, record_reader, comb
         if not isinstance(end_byte, (int, long)):
             raise Exception('end_byte must be an integer')
 
-        fobj = cloud.files.getf(file_name, start_byte, file_size)
-
-        rr_it = record_reader(fobj, end_byte)
-        if type(rr_it) != types.GeneratorType:
-            raise Exception('record_reader is not a generator')
+        if split:
+            processes, new_pickler = split
+            processes = min(processes, max((end_byte - start_byte) // split_min_bytes, 1))
+            if processes > 1:
+                return split_map(map_range, start_byte, end_byte, processes, new_pickler, output)
 
-        if hasattr(itertools.chain, 'from_iterable'):  #Python2.6+
-            map_results_it = itertools.chain.from_iterable( itertools.imap(mapper, rr_it) )
-        else:
-            map_results_it = ( map_result for map_result in itertools.imap(mapper, rr_it) )
+        return map_range(start_byte, end_byte, output)
 
-        comb = combiner(map_results_it)
-        if type(comb) != types.GeneratorType:
-            raise Exception('combiner is not a generator')
+    return inner
 
-        try:
-            result = __builtin__.list( comb )
-        except Exception as e:
-            if e.message.find("is not iterable") > 0 :
-                msg = e.message + "\n\nThis could be an issue with the mapper function not returning an iterable.\nPlease make sure that the mapper() is either a generator object or returns an iteratable."
-                raise Exception(msg)
-            else:
-                raise e
+# the least bytes a split mapper hands each child
+split_min_bytes = 1048576
+
+class _SplitOutput(object):
+    """Where a split mapper child puts its output: a file of pickled
+    ('items', batch) records, of which each is pickled on its own."""
+
+    def __init__(self, f, new_pickler, batch_size=1000):
+        self._f = f
+        self._new_pickler = new_pickler
+        self._batch_size = batch_size
+        self._batch = []
+
+    def extend(self, items):
+        for item in items:
+            self._batch.append(item)
+            if len(self._batch) >= self._batch_size:
+                self.flush()
+
+    def flush(self):
+        if self._batch:
+            self._new_pickler(self._f).dump(('items', self._batch))
+            self._batch = []
+
+def split_map(map_range, start_byte, end_byte, processes, new_pickler, output=None):
+    """Maps a byte range with *processes* forked children, each running
+    map_range on an equal part of it. Parts are cut at arbitrary bytes,
+    same as the boss cuts a file into jobs, and the record reader aligns
+    them to records. The children write their output to temp files, which
+    are merged in the order of the parts into *output* or a new list."""
+
+    bounds = [start_byte + (end_byte - start_byte) * i // processes for i in range(processes + 1)]
+    log.logger.info('Splitting mapper range %s-%s at %s' % (start_byte, end_byte, bounds[1:-1]))
+
+    children = []
+    try:
+        for part_start, part_end in zip(bounds, bounds[1:]):
+            f = tempfile.TemporaryFile()
+            pid = os.fork()
+            if pid == 0:
+                status = 0
+                try:
+                    part_output = _SplitOutput(f, new_pickler)
+                    map_range(part_start, part_end, part_output)
+                    part_output.flush()
+                except BaseException:
+                    new_pickler(f).dump(('error', traceback.format_exc()))
+                    status = 1
+                finally:
+                    f.close()
+                    # skip the job's finally blocks and atexit handlers
+                    os._exit(status)
+            children.append((pid, f))
+
+        result = output if output is not None else []
+        while children:
+            pid, f = children[0]
+            pid, status = os.waitpid(pid, 0)
+            children.pop(0)
+
+            try:
+                f.seek(0)
+                unpickler = pickle.Unpickler(f)
+                while True:
+                    try:
+                        kind, value = unpickler.load()
+                    except EOFError:
+                        break
+                    if kind == 'error':
+                        raise Exception('Mapper child for a split range failed:\n%s' % value)
+                    result.extend(value)
+            finally:
+                f.close()
+
+            if status:
+                raise Exception('Mapper child for a split range ended with status %s' % status)
 
-        fobj.close()
         return result
+    finally:
+        for pid, f in children:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            f.close()
+
+def reducer_generator(reducer, prefetch=None):
+    """Returns the function a filemap reducer job runs. With *prefetch* a
+    (concurrency, window, ordered) tuple, map results are fetched by a
+    ResultPrefetcher, one jid per fetch."""
 
-    return inner
-
-def reducer_generator(reducer):
     import scicloud as cloud
 
     def ch_reducer(jids):
 
         c = cloud._getcloud()
         res = getattr( c, '_Cloud__iresult' )
-        all_map_results_it = res(jids, by_jid=True)
+        if prefetch:
+            def fetch(jid):
+                for map_results in res([jid], by_jid=True):
+                    return map_results
+            prefetcher = ResultPrefetcher(fetch, jids, *prefetch)
+            all_map_results_it = iter(prefetcher)
+        else:
+            all_map_results_it = res(jids, by_jid=True)
 
         if hasattr(itertools.chain, 'from_iterable'):  #Python2.6+
             flattened_map_results = itertools.chain.from_iterable(all_map_results_it)
         else:
             flattened_map_results = (map_result for map_result in all_map_results_it)
 
-        red = reducer( flattened_map_results )
-        if not hasattr(red, '__iter__'):
-            raise Exception('reducer is not an iterable')
-        final_result = __builtin__.list( red ) #must return list for it to be serializable
+        try:
+            red = reducer( flattened_map_results )
+            if not hasattr(red, '__iter__'):
+                raise Exception('reducer is not an iterable')
+            final_result = __builtin__.list( red ) #must return list for it to be serializable
+        finally:
+            if prefetch:
+                # stops the fetching threads if the reducer did not get to
+                # the end
+                all_map_results_it.close()
+                job_local.stats['reducer_prefetch'] = prefetcher.stats()
 
         return final_result
 
     return ch_reducer
-
-
@@ -0,0 +1,93 @@
+"""
+Pipelined job intake. With 'pipeline' set in the setup message, the boss
+may send the next assign before the current job has finished. A
+JobPipeline reads messages on a background thread and deserializes each
+assign as it arrives, so the job starts the moment the one before it is
+done rather than after its own unpickling.
+
+Messages still come out in the order they arrived, and the job owner is
+still set up when the job starts. Unpickling runs code of the job, so a job
+is only deserialized ahead while the owner set up is its own. Otherwise
+that is left to when it starts.
+"""
+
+import threading
+import Queue
+
+class JobPipeline(object):
+    """Reads messages from the client *c* ahead of the job loop, and calls
+    *prepare* on those whose type is in *types*. At most *depth* prepared
+    messages wait to be taken, besides the one being prepared.
+
+    *waiting* is an Event set while the job loop waits on a job. It is also
+    set while the loop waits in read. Messages are only prepared while it
+    is set, so preparing does not compete with a job being set up.
+
+    *key*, if given, is called with a message. Only messages whose key is
+    that of the message of those types taken last are prepared."""
+
+    def __init__(self, c, prepare, waiting, types=('assign',), depth=1, key=None):
+        self._c = c
+        self._prepare = prepare
+        self._waiting = waiting
+        self._types = types
+        self._key = key
+        # key of the message of *types* taken last, None before the first
+        self._taken_key = None
+        # set by drain, after which nothing is prepared
+        self._ending = False
+        # the message read and not yet queued
+        self._held = None
+        self._messages = Queue.Queue(depth)
+        self.thread = threading.Thread(target=self._run, name='JobPipeline')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            m = self._held = self._c.read()
+            if m.meta['type'] in self._types and not self._ending:
+                self._waiting.wait()
+                # the loop is waiting, so the message it took last is the
+                # one its job was set up for
+                if (self._key is None or self._key(m) == self._taken_key) and not self._ending:
+                    self._prepare(m)
+            self._messages.put(m)
+            self._held = None
+            if m.meta['type'] == 'die':
+                break
+
+    def read(self):
+        """The next message, same as the client's read"""
+
+        m = self._get()
+        if self._key is not None and m.meta['type'] in self._types:
+            self._taken_key = self._key(m)
+        return m
+
+    def drain(self):
+        """The messages read and not taken, for a job loop that ends. Any
+        being prepared is waited for."""
+
+        self._ending = True
+        # lets a message held back for the loop to wait through
+        self._waiting.set()
+        messages = []
+        while True:
+            try:
+                messages.append(self._messages.get(timeout=0.05))
+            except Queue.Empty:
+                if self._held is None:
+                    return messages
+
+    def _get(self):
+        try:
+            return self._messages.get_nowait()
+        except Queue.Empty:
+            pass
+
+        self._waiting.set()
+        try:
+            return self._messages.get()
+        finally:
+            self._waiting.clear()
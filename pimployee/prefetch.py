@@ -0,0 +1,238 @@
+"""
+Read-ahead for filemap jobs. A PrefetchingReader fetches the next blocks of
+a mapper's file on a background thread while the record reader parses the
+current one, and a ResultPrefetcher fetches the map results a reducer
+consumes several at a time. Either way fetching overlaps with the job's own
+work instead of taking turns with it.
+"""
+
+import sys
+import time
+import threading
+import Queue
+
+class PrefetchingReader(object):
+    """File-like wrapper that reads *fobj* ahead in blocks of *block_size*
+    bytes, keeping at most *depth* of them waiting. Supports read,
+    readline, iteration over lines, tell and close.
+
+    *bytes_read* counts bytes handed to the reader, and *stall_time* the
+    seconds it waited for a block that was not fetched yet."""
+
+    def __init__(self, fobj, block_size=1048576, depth=4):
+        self._fobj = fobj
+        self.block_size = block_size
+        self.depth = depth
+        self.bytes_read = 0
+        self.stall_time = 0.0
+
+        try:
+            self._start = fobj.tell()
+        except (AttributeError, IOError):
+            self._start = None
+
+        # current block, and how much of it was handed out
+        self._buffer = ''
+        self._offset = 0
+        self._eof = False
+
+        # blocks, '' at the end of the file, or the exc_info of a failed read
+        self._blocks = Queue.Queue(depth)
+        self._stop = False
+        self._thread = threading.Thread(target=self._fetch, name='PrefetchingReader')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fetch(self):
+        try:
+            while not self._stop:
+                block = self._fobj.read(self.block_size)
+                self._blocks.put(block)
+                if not block:
+                    break
+        except Exception:
+            self._blocks.put(sys.exc_info())
+
+    def _next_block(self):
+        """Makes the next block current. Returns False at the end of the
+        file."""
+
+        if self._eof:
+            return False
+
+        start = time.time()
+        block = self._blocks.get()
+        self.stall_time += time.time() - start
+
+        if isinstance(block, tuple):
+            self._eof = True
+            raise block[0], block[1], block[2]
+        if not block:
+            self._eof = True
+
+        self._buffer = block
+        self._offset = 0
+        return not self._eof
+
+    def read(self, size=-1):
+        pieces = []
+        length = 0
+        while True:
+            if size < 0:
+                end = len(self._buffer)
+            else:
+                end = min(len(self._buffer), self._offset + size - length)
+            piece = self._buffer[self._offset:end]
+            self._offset = end
+            pieces.append(piece)
+            length += len(piece)
+            if length == size or not self._next_block():
+                break
+
+        self.bytes_read += length
+        return ''.join(pieces)
+
+    def readline(self, size=-1):
+        pieces = []
+        length = 0
+        while True:
+            end = self._buffer.find('\n', self._offset) + 1 or len(self._buffer)
+            if size >= 0:
+                end = min(end, self._offset + size - length)
+            piece = self._buffer[self._offset:end]
+            self._offset = end
+            pieces.append(piece)
+            length += len(piece)
+            if piece.endswith('\n') or length == size or not self._next_block():
+                break
+
+        self.bytes_read += length
+        return ''.join(pieces)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def tell(self):
+        if self._start is None:
+            raise IOError('Underlying file does not support tell')
+        return self._start + self.bytes_read
+
+    def close(self):
+        """Stops the fetching thread, which the job's thread check would
+        otherwise find still running, and closes the file."""
+
+        self._stop = True
+        while self._thread.is_alive():
+            # unblock a fetch waiting for room
+            try:
+                while True:
+                    self._blocks.get_nowait()
+            except Queue.Empty:
+                pass
+            self._thread.join(0.01)
+        self._fobj.close()
+
+    def stats(self):
+        return {'bytes_read': self.bytes_read,
+                'stall_time': self.stall_time,
+                'block_size': self.block_size,
+                'depth': self.depth}
+
+def local_getf(file_name, start_byte, file_size):
+    """Stand-in for cloud.files.getf that reads a local file, for running
+    mappers without the file store."""
+
+    fobj = open(file_name, 'rb')
+    fobj.seek(start_byte)
+    return fobj
+
+class ResultPrefetcher(object):
+    """Iterates over fetch(key) for every key in *keys*, fetching up to
+    *concurrency* of them at once on background threads, so fetching and
+    deserializing overlap with the consumer. At most *window* results are
+    fetched ahead of it. If *ordered*, results come in the order of *keys*,
+    else in the order they arrive.
+
+    *stall_time* is the seconds the consumer waited for a result."""
+
+    def __init__(self, fetch, keys, concurrency=4, window=None, ordered=True):
+        self._fetch = fetch
+        self._keys = list(keys)
+        self.concurrency = max(concurrency, 1)
+        self.window = max(window or 2 * self.concurrency, self.concurrency)
+        self.ordered = ordered
+        self.fetched = 0
+        self.stall_time = 0.0
+
+    def __iter__(self):
+        # a slot is taken before a key is, and given back once its result
+        # is consumed. keys are taken in order, so in ordered mode the
+        # result the consumer waits for always holds a slot
+        slots = threading.Semaphore(self.window)
+        todo = Queue.Queue()
+        for index, key in enumerate(self._keys):
+            todo.put((index, key))
+        # (index, result, exc_info of a failed fetch or None)
+        done = Queue.Queue()
+        stop = []
+
+        def work():
+            while True:
+                slots.acquire()
+                try:
+                    index, key = todo.get_nowait()
+                except Queue.Empty:
+                    index = None
+                if index is None or stop:
+                    slots.release()
+                    return
+                try:
+                    done.put((index, self._fetch(key), None))
+                except Exception:
+                    done.put((index, None, sys.exc_info()))
+
+        threads = []
+        for i in range(min(self.concurrency, len(self._keys))):
+            th = threading.Thread(target=work, name='ResultPrefetcher')
+            th.daemon = True
+            th.start()
+            threads.append(th)
+
+        try:
+            buffered = {}
+            for next_index in range(len(self._keys)):
+                start = time.time()
+                if self.ordered:
+                    while next_index not in buffered:
+                        index, result, error = done.get()
+                        buffered[index] = (result, error)
+                    result, error = buffered.pop(next_index)
+                else:
+                    index, result, error = done.get()
+                self.stall_time += time.time() - start
+
+                slots.release()
+                if error:
+                    raise error[0], error[1], error[2]
+                self.fetched += 1
+                yield result
+        finally:
+            # the job's thread check must not find the workers running
+            stop.append(True)
+            for th in threads:
+                slots.release()
+            for th in threads:
+                th.join()
+
+    def stats(self):
+        return {'fetched': self.fetched,
+                'stall_time': self.stall_time,
+                'concurrency': self.concurrency,
+                'window': self.window,
+                'ordered': self.ordered}
@@ -0,0 +1,65 @@
+"""
+Statistical profiler, the low overhead alternative to cProfile for jobs
+with profile_mode 'sampling'.
+
+A profiling interval timer delivers SIGPROF after every *interval* seconds
+of CPU time used by the process. The handler records the stack of every
+thread, so cost grows with the sampling rate rather than with the number of
+calls the job makes. Stacks are kept collapsed, ready for flamegraph.pl.
+
+Signal handlers only run in the main thread, which is where jobs run.
+"""
+
+import sys
+import thread
+import signal
+import threading
+import collections
+
+class SamplingProfiler(object):
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = 0
+        # collapsed stack -> times it was seen
+        self.counts = collections.defaultdict(int)
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        # restart system calls the timer interrupts, rather than have them
+        # fail with EINTR in user code
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def _sample(self, signum, frame):
+        self.samples += 1
+
+        # threading.enumerate takes a lock the interrupted code may hold
+        names = dict((ident, th.name) for ident, th in threading._active.items())
+        current = thread.get_ident()
+
+        for ident, thread_frame in sys._current_frames().items():
+            if ident == current:
+                # the interrupted frame, not this handler
+                thread_frame = frame
+            self.counts[self._collapse(names.get(ident, ident), thread_frame)] += 1
+
+    @staticmethod
+    def _collapse(thread_name, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%s)' % (code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        stack.append(str(thread_name))
+        return ';'.join(reversed(stack))
+
+    def collapsed(self):
+        """Returns one 'frame;frame;frame count' line per distinct stack,
+        root first, with the thread name as the root."""
+
+        return '\n'.join('%s %s' % (stack, count) for stack, count in self.counts.iteritems())
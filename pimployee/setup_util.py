@@ -1,5 +1,6 @@
 import os
 import sys
+import time
 import socket
 
 
@@ -42,16 +43,24 @@ def substitute_stderr_pipe(m):
 import fcntl
 import atfork
 
-def connect_to_boss(address, port):
-    # -- original code:
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # set timeout to None since we now set a default finite timeout
-    s.settimeout(None)
-    s.connect((address, port))
-    #try:
-    #    s.connect('./picloud.sock')
-    #except Exception as e:
-    #    print e
+def connect_to_boss(address, port=None, nodelay=True):
+    """Connects to the boss at *address*:*port* over TCP, or if *port* is
+    None, at the unix domain socket path *address*, which also lets
+    descriptors be passed."""
+
+    if port is None:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(None)
+        s.connect(address)
+    else:
+        # -- original code:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # set timeout to None since we now set a default finite timeout
+        s.settimeout(None)
+        # the client coalesces small messages itself and holds back heads of
+        # large ones with MSG_MORE, so Nagle only adds latency
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if nodelay else 0)
+        s.connect((address, port))
 
     # susceptible to race conditions
     # closes file descriptor on exec and fork
@@ -93,6 +102,26 @@ def setup_cloud(hostname, ap_version):
 
     cloud.config.commit()
 
+def preload_modules(names):
+    """Imports the modules *names*, so that jobs do not pay for it.
+    Returns the seconds each import took, and the error of each one that
+    failed. A module imported by an earlier one in the list takes no time
+    of its own."""
+
+    import importlib
+    import traceback
+
+    times = {}
+    errors = {}
+    for name in names:
+        start = time.time()
+        try:
+            importlib.import_module(name)
+        except Exception:
+            errors[name] = traceback.format_exc().splitlines()[-1]
+        times[name] = time.time() - start
+    return times, errors
+
 def setup_faulthandler(m):
     # for reporting the Python line at which a segfault occurs
     try:
@@ -141,7 +170,117 @@ def setup_sys_path(ap_version, ap_path, archive_path):
 
 
 import imp
+import json
 import site
+import zipfile
+import tempfile
+
+def _pth_dirs(sitedir, name):
+    """Returns the existing paths a .pth file *name* in *sitedir* adds,
+    the way site.addpackage reads it, and whether it has import lines too."""
+
+    paths = []
+    imports = False
+    try:
+        with open(os.path.join(sitedir, name)) as f:
+            for line in f:
+                if line.startswith(('import ', 'import\t')):
+                    imports = True
+                    continue
+                if line.startswith('#'):
+                    continue
+                path = os.path.join(sitedir, line.rstrip())
+                if line.strip() and os.path.exists(path):
+                    paths.append(path)
+    except IOError:
+        pass
+    return paths, imports
+
+def _top_level_names(path):
+    """Returns the names of the modules and packages importable at top level
+    from *path*, a directory or a zipped egg."""
+
+    suffixes = [suffix for suffix, mode, kind in imp.get_suffixes()]
+    names = set()
+
+    if os.path.isfile(path):
+        try:
+            entries = zipfile.ZipFile(path).namelist()
+        except (IOError, zipfile.BadZipfile):
+            return names
+        for entry in entries:
+            parts = entry.split('/')
+            if len(parts) == 2 and parts[1] in ('__init__.py', '__init__.pyc'):
+                names.add(parts[0])
+            elif len(parts) == 1:
+                names.update(entry[:-len(suffix)] for suffix in suffixes if entry.endswith(suffix))
+        return names
+
+    for entry in os.listdir(path):
+        full = os.path.join(path, entry)
+        if os.path.isdir(full):
+            if any(os.path.exists(os.path.join(full, '__init__' + suffix)) for suffix in suffixes):
+                names.add(entry)
+        else:
+            names.update(entry[:-len(suffix)] for suffix in suffixes if entry.endswith(suffix))
+    return names
+
+def build_lazy_index(lazy_dir):
+    """Maps each top-level name that the sitedirs in *lazy_dir* provide,
+    directly or through their .pth files, to its sitedir. Where sitedirs
+    overlap the first one listed wins, same as adding them all in order.
+
+    Also returns the sitedirs with .pth files that have import lines. What
+    those create, like the namespace packages of setuptools' -nspkg.pth
+    files, is only known once they run."""
+
+    index = {}
+    pth_import_sitedirs = []
+    for sub_path in os.listdir(lazy_dir):
+        sitedir = os.path.join(lazy_dir, sub_path)
+        if not os.path.isdir(sitedir):
+            continue
+        paths = [sitedir]
+        for name in os.listdir(sitedir):
+            if name.endswith('.pth'):
+                pth_paths, imports = _pth_dirs(sitedir, name)
+                paths.extend(pth_paths)
+                if imports and sitedir not in pth_import_sitedirs:
+                    pth_import_sitedirs.append(sitedir)
+        for path in paths:
+            for name in _top_level_names(path):
+                index.setdefault(name, sitedir)
+    return index, pth_import_sitedirs
+
+def load_lazy_index(lazy_dir):
+    """Returns build_lazy_index(*lazy_dir*), cached in the temp directory
+    for as long as the mtime of *lazy_dir* stays the same."""
+
+    mtime = os.stat(lazy_dir).st_mtime
+    cache_path = os.path.join(tempfile.gettempdir(),
+                              'lazy_index_%s.json' % lazy_dir.strip('/').replace('/', '_'))
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached['lazy_dir'] == lazy_dir and cached['mtime'] == mtime:
+            return cached['index'], cached['pth_import_sitedirs']
+    except (IOError, ValueError, KeyError):
+        pass
+
+    index, pth_import_sitedirs = build_lazy_index(lazy_dir)
+
+    # written aside and renamed, so concurrent workers never read half a file
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'lazy_dir': lazy_dir, 'mtime': mtime, 'index': index,
+                       'pth_import_sitedirs': pth_import_sitedirs}, f)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError):
+        import log
+        log.logger.warning('Could not cache lazy import index at %s' % cache_path)
+
+    return index, pth_import_sitedirs
 
 def lazy_importer(target_path):
 
@@ -152,9 +291,19 @@ def lazy_importer(target_path):
         module.
         http://www.python.org/dev/peps/pep-0302/
 
+        Only the sitedir that provides the requested module is added to
+        sys.path, found through an index of the whole lazy_dir. A module
+        the index lacks may come from a .pth import line, so on a miss the
+        sitedirs with such lines are all added.
+
         TODO: Rename this!
         """
 
+        # top-level name -> sitedir, shared by every instance
+        index = None
+        pth_import_sitedirs = None
+        added = set()
+
         def __init__(self, lazy_dir):
             """lazy_dir is a directory of packages to import lazily"""
 
@@ -164,25 +313,46 @@ def lazy_importer(target_path):
                 self.lazy_dir = lazy_dir
 
         def find_module(self, fullname, path=None):
-            try:
-                sub_paths = os.listdir(self.lazy_dir)
-            except OSError:
-                import log
-                log.logger.warning('Could not read lazy_dir %s' % self.lazy_dir)
-                raise ImportError #obey PEP 302
-
             imp.acquire_lock()
-            if self.lazy_dir in sys.path:
-                for path in sub_paths:
-                    site.addsitedir(os.path.join(self.lazy_dir, path))
-                sys.path.remove(self.lazy_dir)
-            imp.release_lock()
-
-            return self
+            try:
+                cls = LazySiteImporter
+                if cls.index is None:
+                    try:
+                        cls.index, cls.pth_import_sitedirs = load_lazy_index(self.lazy_dir)
+                    except OSError:
+                        import log
+                        log.logger.warning('Could not read lazy_dir %s' % self.lazy_dir)
+                        return None #obey PEP 302
+
+                sitedir = cls.index.get(fullname.partition('.')[0])
+                if sitedir is None:
+                    # namespace packages span sitedirs, so all of them
+                    sitedirs = [d for d in cls.pth_import_sitedirs if d not in cls.added]
+                elif sitedir not in cls.added:
+                    sitedirs = [sitedir]
+                else:
+                    sitedirs = []
+                if not sitedirs:
+                    # the module is not in lazy_dir, or an added sitedir
+                    # lacks it as the index is stale. let the import fail
+                    # rather than recurse
+                    return None
+
+                for sitedir in sitedirs:
+                    cls.added.add(sitedir)
+                    site.addsitedir(sitedir)
+                # keep lazy_dir behind the sitedirs, so that they are
+                # searched before it from now on
+                if self.lazy_dir in sys.path:
+                    sys.path.remove(self.lazy_dir)
+                    sys.path.append(self.lazy_dir)
+                return self
+            finally:
+                imp.release_lock()
 
         def load_module(self, fullname):
-            mod = __import__(fullname)
-            return mod
+            __import__(fullname)
+            return sys.modules[fullname]
 
     return LazySiteImporter
 
@@ -0,0 +1,53 @@
+"""
+Memory backed files, for handing large results to the boss as a descriptor
+rather than pushing them through the socket.
+
+memfd_create is wrapped by neither python 2 nor older libcs, so it is made
+as a raw system call. Where it is missing, an unlinked file in /dev/shm
+does the same job.
+"""
+
+import os
+import ctypes
+import platform
+import tempfile
+
+# memfd_create system call numbers
+_SYS_MEMFD_CREATE = {'x86_64': 319,
+                     'i386': 356,
+                     'i686': 356,
+                     'aarch64': 279,
+                     'armv7l': 385}.get(platform.machine())
+MFD_CLOEXEC = 1
+
+SHM_DIR = '/dev/shm'
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+def create(name):
+    """Returns the descriptor of a new, empty, memory backed file. *name*
+    only shows up in /proc/<pid>/fd."""
+
+    if _SYS_MEMFD_CREATE is not None:
+        fd = _libc.syscall(_SYS_MEMFD_CREATE, name, MFD_CLOEXEC)
+        if fd >= 0:
+            return fd
+
+    fd, path = tempfile.mkstemp(prefix=name, dir=SHM_DIR if os.path.isdir(SHM_DIR) else None)
+    os.unlink(path)
+    return fd
+
+def write(name, data):
+    """Returns the descriptor of a new memory backed file holding *data*,
+    positioned at its start."""
+
+    fd = create(name)
+    try:
+        written = 0
+        while written < len(data):
+            written += os.write(fd, buffer(data, written))
+        os.lseek(fd, 0, os.SEEK_SET)
+    except:
+        os.close(fd)
+        raise
+    return fd
@@ -1,8 +1,173 @@
+import os
+import sys
 import json
+import time
+import zlib
+import mmap
+import errno
+import fcntl
+import select
+import socket
+import struct
+import marshal
 import passfd
 import threading
+import collections
 import Queue
 
+# legacy framing: a META_LENGTH block of space padded json, then the payload
+PROTOCOL_LEGACY = 1
+# binary framing: a fixed HEADER of (meta codec, meta length, payload length),
+# then the encoded meta and the payload. Negotiated at registration.
+PROTOCOL_BINARY = 2
+PROTOCOLS = [PROTOCOL_LEGACY, PROTOCOL_BINARY]
+
+HEADER = struct.Struct('!BII')
+
+# meta codec name -> (id sent in HEADER, dumps, loads)
+META_CODECS = {'json': (0, json.dumps, json.loads),
+               'marshal': (1, marshal.dumps, marshal.loads)}
+META_DECODERS = dict((codec_id, loads) for codec_id, dumps, loads in META_CODECS.values())
+
+# payload compression modes -> zlib level. either side flags a compressed
+# payload with meta['payload_codec'], so it can always be decoded
+COMPRESSION_LEVELS = {'zlib': 6, 'fast': 1}
+PAYLOAD_CODECS = ['zlib']
+# payloads smaller than this are not worth compressing
+COMPRESSION_THRESHOLD = 65536
+
+# payloads at least this large are written from their own buffer instead of
+# being joined with their head, or with other queued messages
+COALESCE_MAX_PAYLOAD = 65536
+# the most bytes of queued small messages that are joined into a single write
+COALESCE_MAX_BYTES = 262144
+
+# python 2 does not export MSG_MORE. it asks linux to hold back a write until
+# the next one, so a head and its separately written payload share packets
+MSG_MORE = getattr(socket, 'MSG_MORE', 0x8000 if sys.platform.startswith('linux') else 0)
+
+# the byte a passed descriptor is attached to
+FD_BYTE = '\0'
+
+def send_fd(sock, fileno):
+    """Passes the descriptor *fileno* over the unix domain socket *sock*.
+    Errors are raised as socket.error, like the socket's own."""
+
+    try:
+        passfd.sendfd(sock, fileno, FD_BYTE)
+    except OSError, e:
+        raise socket.error(e.errno, e.strerror)
+
+def recv_fd(sock):
+    """Receives a descriptor passed with send_fd, reading no further than
+    its byte."""
+
+    try:
+        fileno, data = passfd.recvfd(sock, len(FD_BYTE))
+    except OSError, e:
+        raise socket.error(e.errno, e.strerror)
+    except RuntimeError, e:
+        # no descriptor came, as when the connection was lost
+        raise IOError(str(e))
+    return fileno
+
+# bytes of frames queued for sending before bulk producers are held back
+SEND_QUEUE_BYTES = 64 * 1024 * 1024
+# messages that go out ahead of bulk data. only ones whose order relative to
+# other messages does not matter to the boss belong here
+CONTROL_TYPES = frozenset(['hb'])
+
+class SendQueue(object):
+    """Queue of (head, payload, fileno, callback) frames waiting for the sender,
+    with a budget of *limit* bytes. A bulk producer blocks while the frames
+    already queued and its own would exceed the limit. A frame larger than
+    the limit goes through once the queue is empty. Control frames never
+    block and are handed out before bulk ones.
+
+    None, the sender's stop sentinel, queues as bulk, so everything put
+    before it is still sent."""
+
+    def __init__(self, limit=SEND_QUEUE_BYTES):
+        self.limit = limit
+        self._control = collections.deque()
+        self._bulk = collections.deque()
+        self._bytes = 0
+        self._peak_bytes = 0
+        self._blocked_seconds = 0.0
+        # set once nothing will ever be sent again
+        self._closed = False
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def _size(item):
+        if item is None:
+            return 0
+        return len(item[0]) + len(item[1])
+
+    def put(self, item, control=False):
+        size = self._size(item)
+        with self._cond:
+            if self._closed:
+                if item and item[-1]:
+                    item[-1]()
+                return
+            if not control and self._over_limit(size):
+                start = time.time()
+                while self._over_limit(size) and not self._closed:
+                    self._cond.wait()
+                self._blocked_seconds += time.time() - start
+                if self._closed:
+                    if item and item[-1]:
+                        item[-1]()
+                    return
+
+            if control:
+                self._control.append(item)
+            else:
+                self._bulk.append(item)
+            self._bytes += size
+            self._peak_bytes = max(self._peak_bytes, self._bytes)
+            self._cond.notify_all()
+
+    def _over_limit(self, size):
+        return self._bytes and self._bytes + size > self.limit
+
+    def get(self, block=True):
+        with self._cond:
+            while not self._control and not self._bulk:
+                if not block:
+                    raise Queue.Empty
+                self._cond.wait()
+            item = (self._control or self._bulk).popleft()
+            self._bytes -= self._size(item)
+            self._cond.notify_all()
+            return item
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def close(self):
+        """Drops whatever is queued and everything put from now on, running
+        their callbacks so that no producer waits on them forever."""
+
+        with self._cond:
+            self._closed = True
+            dropped = list(self._control) + list(self._bulk)
+            self._control.clear()
+            self._bulk.clear()
+            self._bytes = 0
+            self._cond.notify_all()
+        for item in dropped:
+            if item and item[-1]:
+                item[-1]()
+
+    def report(self):
+        with self._cond:
+            return {'depth': len(self._control) + len(self._bulk),
+                    'bytes': self._bytes,
+                    'peak_bytes': self._peak_bytes,
+                    'blocked_seconds': self._blocked_seconds}
+
 class Sender(threading.Thread):
     
     def __init__(self, socket, sq, rq):
@@ -13,17 +178,31 @@ class Sender(threading.Thread):
 
     def run(self):
         while True:
-            to_send = self._sq.get()
-            if to_send is None:
-                break
+            batch = [self._sq.get()]
+            batch_bytes = 0
+            # drain messages that queued up meanwhile, so a burst of small
+            # messages costs one write rather than one each
+            while batch[-1] is not None and batch_bytes < COALESCE_MAX_BYTES:
+                head, payload, fileno, callback = batch[-1]
+                if len(payload) >= COALESCE_MAX_PAYLOAD:
+                    break
+                batch_bytes += len(head) + len(payload)
+                try:
+                    batch.append(self._sq.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = None in batch
+            batch = [to_send for to_send in batch if to_send is not None]
             try:
-                self._socket.sendall(to_send)
+                self._write(batch)
             except IOError, e:
-                m = Message()
-                m.meta = {"type": 'die'}
-                m.ready.set()
-                self._rq.put_nowait(m)
+                self._rq.put(Message.die())
                 self._socket.close()
+                self._sent(batch)
+                self._sq.close()
+                break
+            self._sent(batch)
+            if stop:
                 break
         """
             to_send = None
@@ -42,90 +221,228 @@ class Sender(threading.Thread):
                 break
         """
 
+    def _sent(self, batch):
+        for head, payload, fileno, callback in batch:
+            if callback:
+                callback()
+
+    def _write(self, batch):
+        """Writes a list of (head, payload, fileno, callback) frames. Small
+        frames are joined into one sendall. Large payloads are sent from
+        their own buffer, right after the joined bytes before them, so they
+        are never copied. A descriptor goes right after its frame."""
+
+        pieces = []
+        for head, payload, fileno, callback in batch:
+            pieces.append(head)
+            if isinstance(payload, str) and len(payload) < COALESCE_MAX_PAYLOAD:
+                pieces.append(payload)
+            else:
+                self._socket.sendall(''.join(pieces), MSG_MORE)
+                self._socket.sendall(payload)
+                pieces = []
+            if fileno is not None:
+                self._socket.sendall(''.join(pieces))
+                send_fd(self._socket, fileno)
+                pieces = []
+        if pieces:
+            self._socket.sendall(''.join(pieces))
+
 class Receiver(threading.Thread):
     
-    def __init__(self, socket, rq, sq):
+    def __init__(self, socket, rq, sq, framing):
         super(Receiver, self).__init__()
         self._rq = rq
         self._sq = sq
         self._socket = socket
+        self._framing = framing
 
     def run(self):
-        message = Message()
+        message = self._framing.new_message()
         while True:
             try:
                 message.read(self._socket)
             except IOError, e:
-                m = Message()
-                m.meta = {"type": 'die'}
-                m.ready.set()
-                self._rq.put_nowait(m)
+                self._rq.put(Message.die())
                 break
             if message.is_ready():
+                message.received_at = time.time()
                 if message.meta["type"] == "hb":
-                    self._sq.put_nowait(Message.serialize_message({"type": "hb"}))
+                    # the boss learns how far behind the sender is
+                    self._sq.put(self._framing.frame({"type": "hb", "send_queue": self._sq.report()}) + (None, None),
+                                 control=True)
                 else:
+                    self._framing.decode(message)
+                    if message.meta["type"] == "setup":
+                        # switch before reading the next message, which the
+                        # boss sends in whatever framing it accepted
+                        self._framing.accept(message.meta)
                     self._rq.put(message)
-                message = Message()
+                message = self._framing.new_message()
 
 class Message(object):
     """Represents the unit by which we send messages between our socket
     clients."""
     
+    STATE_HEADER = 'HEADER'
     STATE_META = 'META'
     STATE_PAYLOAD = 'PAYLOAD'
+    # a descriptor the boss sent along follows the frame
+    STATE_FD = 'FD'
     STATE_READY = 'READY'
     META_LENGTH = 1024
     
-    def __init__(self):
+    def __init__(self, protocol=PROTOCOL_LEGACY):
         self.bytes_so_far = 0
-        self.ready = threading.Event()
+        self.received_at = None
         
-        self.state = self.STATE_META
+        self.protocol = protocol
         self.meta = ''
         self.payload = ''
+
+        # header, meta and payload are each received into a preallocated
+        # buffer with recv_into, rather than by concatenating recv chunks
+        if protocol == PROTOCOL_BINARY:
+            self._expect(self.STATE_HEADER, bytearray(HEADER.size))
+        else:
+            self._meta_loads = json.loads
+            self._expect(self.STATE_META, bytearray(self.META_LENGTH))
         
     
     def read(self, socket):
         """Socket should have something to be read."""
+
+        if self.state == self.STATE_HEADER:
+            self._recv_into(socket)
+            if self.bytes_so_far == len(self._buffer):
+                codec_id, meta_length, self._payload_length = HEADER.unpack(str(self._buffer))
+                self._meta_loads = META_DECODERS[codec_id]
+                self._expect(self.STATE_META, bytearray(meta_length))
         
         if self.state == self.STATE_META:
             #print 'receiving meta'
-            chunk = socket.recv(self.META_LENGTH - len(self.meta))
-            if chunk == "":
-                raise IOError("Connection lost")
-            self.meta += chunk
-            if len(self.meta) == self.META_LENGTH:
+            self._recv_into(socket)
+            if self.bytes_so_far == len(self._buffer):
                 #print 'meta before deserialization', self.meta
-                self.meta = json.loads(self.meta)
-                if self.meta.get('payload_length'):
-                    self.state = self.STATE_PAYLOAD
+                self.meta = self._meta_loads(str(self._buffer))
+                if self.protocol == PROTOCOL_BINARY:
+                    payload_length = self._payload_length
+                else:
+                    payload_length = self.meta.get('payload_length')
+                if payload_length:
+                    # allocate the whole payload once, and fill it in place
+                    self.payload = bytearray(payload_length)
+                    self._expect(self.STATE_PAYLOAD, self.payload)
                     #print 'changed state to payload'
                 else:
-                    self.state = self.STATE_READY
+                    self._expect_end()
                     #print 'changed state to ready'
-                    self.ready.set()
         
         if self.state == self.STATE_PAYLOAD:
             #print 'receiving payload'
-            self.payload += socket.recv(self.meta.get('payload_length') - len(self.payload))
-            #print 'length of payload so far', len(self.payload)
-            if len(self.payload) == self.meta.get('payload_length'):
-                self.state = self.STATE_READY
-                self.ready.set()
+            self._recv_into(socket)
+            #print 'length of payload so far', self.bytes_so_far
+            if self.bytes_so_far == len(self.payload):
+                self._expect_end()
+
+        if self.state == self.STATE_FD:
+            self.meta['fileno'] = recv_fd(socket)
+            self._expect(self.STATE_READY, None)
+
+    def _expect_end(self):
+        if self.meta.get('has_fd'):
+            self._expect(self.STATE_FD, None)
+        else:
+            self._expect(self.STATE_READY, None)
+
+    def _expect(self, state, buffer):
+        """Moves to *state*, which is complete once *buffer* is filled."""
+
+        self.state = state
+        self.bytes_so_far = 0
+        self._buffer = buffer
+        self._view = memoryview(buffer) if buffer is not None else None
+
+    def _recv_into(self, socket):
+        """Receives into the unfilled remainder of the current buffer."""
+
+        received = socket.recv_into(self._view[self.bytes_so_far:])
+        if not received:
+            raise IOError("Connection lost")
+        self.bytes_so_far += received
+
+    def payload_parts(self):
+        """Returns the payload split by the lengths in meta['payload_parts'].
+        Parts are views into the received buffer, or into the mapping of a
+        payload passed as a descriptor, so no bytes are copied. The last
+        part is whatever follows the listed lengths."""
+
+        if self.meta.get('payload_fd') and 'fileno' in self.meta:
+            self._map_payload(self.meta.pop('fileno'))
+
+        if isinstance(self.payload, mmap.mmap):
+            # a mapping only has the old buffer interface
+            part = lambda offset, length: buffer(self.payload, offset, length)
+        else:
+            view = memoryview(self.payload)
+            part = lambda offset, length: view[offset:offset + length]
+
+        parts = []
+        offset = 0
+        for length in self.meta.get('payload_parts', ()):
+            parts.append(part(offset, length))
+            offset += length
+        parts.append(part(offset, len(self.payload) - offset))
+        return parts
+
+    def _map_payload(self, fileno):
+        """Maps the payload the boss passed as the file or memfd *fileno*,
+        instead of inline, read-only, and closes *fileno*. Pages are read
+        on first access and shared with the page cache, so the payload is
+        neither copied through the socket nor held in memory twice."""
+
+        try:
+            size = os.fstat(fileno).st_size
+            # an empty file cannot be mapped
+            self.payload = mmap.mmap(fileno, size, prot=mmap.PROT_READ) if size else ''
+        finally:
+            os.close(fileno)
     
     def is_ready(self):
-        return self.ready.is_set()
-    
-    def block_until_ready(self):
-        self.ready.wait()
+        return self.state == self.STATE_READY
+
+    @classmethod
+    def die(cls):
+        """A ready die message, handed out when the connection is lost."""
+
+        m = cls()
+        m.meta = {"type": 'die'}
+        m._expect(cls.STATE_READY, None)
+        return m
         
     @staticmethod
-    def serialize_message(meta, payload=None, has_fd=False):
+    def serialize_message(meta, payload=None, has_fd=False,
+                          protocol=PROTOCOL_LEGACY, meta_codec='json'):
         """
-        *meta* should be dict that when serialized is less than 1024 bytes.
+        *meta* should be dict that when serialized is less than 1024 bytes,
+        unless *protocol* is PROTOCOL_BINARY, which has no limit.
         *payload* can be a byte string of any length.
         """
+
+        head, payload = Message.frame_message(meta, payload, has_fd, protocol, meta_codec)
+        return head + payload
+
+    @staticmethod
+    def frame_message(meta, payload=None, has_fd=False,
+                      protocol=PROTOCOL_LEGACY, meta_codec='json'):
+        """Same as serialize_message, but returns (head, payload) rather than
+        their concatenation, so that the payload is never copied."""
+
+        if protocol == PROTOCOL_BINARY:
+            codec_id, dumps, loads = META_CODECS[meta_codec]
+            data = dumps(meta)
+            header = HEADER.pack(codec_id, len(data), len(payload) if payload else 0)
+            return header + data, payload or ''
         
         if payload:
             meta['payload_length'] = len(payload)
@@ -137,40 +454,375 @@ class Message(object):
         
         data += ' ' * (Message.META_LENGTH - len(data))
         if payload:
-            data += payload
             del meta['payload_length']
         
         #print 'sending the data of length', len(data)
-        return data
+        return data, payload or ''
+
+
+class Framing(object):
+    """The wire format shared by a client's Sender and Receiver. Starts out
+    legacy, and switches to whatever the boss accepted in its setup
+    message."""
+
+    def __init__(self):
+        self.protocol = PROTOCOL_LEGACY
+        self.meta_codec = 'json'
+        # zlib level for outgoing payloads, or None to send them raw
+        self.compression_level = None
+        self.compression_threshold = COMPRESSION_THRESHOLD
+        self.compression_stats = {'raw_bytes': 0,
+                                  'compressed_bytes': 0,
+                                  'compress_seconds': 0.0,
+                                  'decompress_seconds': 0.0}
+
+    def accept(self, meta):
+        """Adopts the protocol, meta codec and compression accepted in a
+        setup *meta*. A boss that does not know about protocol 2 omits them,
+        and the legacy framing stays in place."""
+
+        if meta.get('protocol') == PROTOCOL_BINARY:
+            self.meta_codec = meta.get('meta_codec') or 'json'
+            if self.meta_codec not in META_CODECS:
+                raise Exception('Boss accepted unknown meta codec %s' % self.meta_codec)
+            self.protocol = PROTOCOL_BINARY
+
+        if meta.get('compression'):
+            self.compression_level = meta.get('compression_level',
+                                              COMPRESSION_LEVELS[meta['compression']])
+            self.compression_threshold = meta.get('compression_threshold', COMPRESSION_THRESHOLD)
+
+    def new_message(self):
+        return Message(self.protocol)
+
+    def frame(self, meta, payload=None, has_fd=False):
+        # has_fd tells the receiver that a descriptor follows the frame. a
+        # forwarded meta may have it set, and the fileno it was received as,
+        # but only *has_fd* counts
+        if has_fd or 'has_fd' in meta:
+            meta = dict(meta)
+            meta.pop('has_fd', None)
+            meta.pop('fileno', None)
+            if has_fd:
+                meta['has_fd'] = True
+        if self.compression_level is not None and payload and len(payload) >= self.compression_threshold:
+            meta, payload = self._compress(meta, payload)
+        return Message.frame_message(meta, payload, has_fd, self.protocol, self.meta_codec)
+
+    def _compress(self, meta, payload):
+        start_time = time.time()
+        compressed = zlib.compress(payload if isinstance(payload, str) else buffer(payload),
+                                   self.compression_level)
+        self.compression_stats['compress_seconds'] += time.time() - start_time
+
+        if len(compressed) >= len(payload):
+            # incompressible, e.g. already compressed data
+            return meta, payload
+
+        self.compression_stats['raw_bytes'] += len(payload)
+        self.compression_stats['compressed_bytes'] += len(compressed)
+        return dict(meta, payload_codec='zlib', payload_raw_length=len(payload)), compressed
+
+    def decode(self, message):
+        """Decompresses the payload of a received *message* in place."""
+
+        if message.meta.get('payload_codec') == 'zlib':
+            start_time = time.time()
+            message.payload = zlib.decompress(buffer(message.payload), 15,
+                                              message.meta['payload_raw_length'])
+            self.compression_stats['decompress_seconds'] += time.time() - start_time
+            del message.meta['payload_codec']
+            del message.meta['payload_raw_length']
+
+    def compression_report(self):
+        report = dict(self.compression_stats)
+        if report['compressed_bytes']:
+            report['ratio'] = float(report['raw_bytes']) / report['compressed_bytes']
+        return report
 
 
 class UnixDomainSocketClient(object):
     
-    def __init__(self, socket):
+    def __init__(self, socket, setup=None, read_ahead=0):
+        """*setup* is a setup meta whose framing is used from the start,
+        for a link where both ends are ours and no setup is exchanged.
+        *read_ahead* bounds the messages received but not read yet, as the
+        socket is not read further while that many wait. 0 for no bound."""
         self._socket = socket
 
-        self._sq = Queue.Queue() 
-        self._rq = Queue.Queue() 
+        self._sq = SendQueue()
+        self._rq = Queue.Queue(read_ahead)
+        self._framing = Framing()
+        if setup:
+            self._framing.accept(setup)
         self._sender = Sender(socket, self._sq, self._rq)
-        self._receiver = Receiver(socket, self._rq, self._sq)
+        self._receiver = Receiver(socket, self._rq, self._sq, self._framing)
         self._sender.daemon = True
         self._receiver.daemon = True
         self._sender.start()
         self._receiver.start()
     
+    def threads(self):
+        """Threads of the client itself, as opposed to ones a job started"""
+        return (self._sender, self._receiver)
+
     def kill(self):
         self._socket.close()
 
+    def close(self):
+        """Sends whatever is queued, then closes the socket. Unlike kill,
+        no message that was already sent is lost."""
+
+        self._sq.put(None)
+        self._sender.join()
+        self._socket.close()
+
     def read(self):
         message = self._rq.get()
         if isinstance(message, BaseException):
             raise message
         return message
 
-    def send(self, meta, payload=None, fileno=None):
+    def send(self, meta, payload=None, fileno=None, callback=None):
         """
         *meta* dict
         *payload* bytes
         *fileno* file descriptor
+        *callback* called from the sender thread once the message is written,
+        which is when *fileno* may be closed
+
+        Blocks while the send queue is over its byte budget, unless *meta*
+        is a control message.
         """
-        self._sq.put_nowait(Message.serialize_message(meta, payload, has_fd=fileno != None))
+        if fileno is not None:
+            if not self.passes_fds:
+                raise Exception('File descriptors can only be passed over a unix domain socket')
+            # a bad descriptor is the caller's error, raised here with
+            # nothing sent. the sender would only find out once the frame
+            # went ahead of it, and have to give up the connection
+            os.fstat(fileno)
+        self._sq.put(self._framing.frame(meta, payload, has_fd=fileno != None) + (fileno, callback),
+                     control=meta['type'] in CONTROL_TYPES)
+
+    @property
+    def send_queue(self):
+        return self._sq
+
+    @property
+    def passes_fds(self):
+        """Whether descriptors can be sent, as only a unix domain socket
+        carries them"""
+        return self._socket.family == socket.AF_UNIX
+
+    def meta_fits(self, meta):
+        """Whether *meta* can be sent in the current framing. Only the
+        legacy framing limits its size."""
+
+        if self._framing.protocol != PROTOCOL_LEGACY:
+            return True
+        # leave room for the payload_length that framing adds
+        return len(json.dumps(dict(meta, payload_length=2 ** 63))) <= Message.META_LENGTH
+
+    def compression_report(self):
+        """Bytes saved and time spent by payload compression so far"""
+        return self._framing.compression_report()
+
+
+class EventLoopClient(UnixDomainSocketClient):
+    """Same interface as UnixDomainSocketClient, but all socket I/O happens
+    on a single thread running a select loop over the non-blocking socket,
+    instead of a Sender and a Receiver thread with a queue between them.
+    Heartbeats are answered inside the loop."""
+
+    # errors that only mean the non-blocking socket has to wait
+    WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+    def __init__(self, socket, setup=None):
+        self._socket = socket
+        self._rq = Queue.Queue()
+        self._framing = Framing()
+        if setup:
+            self._framing.accept(setup)
+
+        self._sq = SendQueue()
+        # None while running, then 'kill' or 'close'
+        self._closing = None
+
+        # the loop sleeps in select, and send wakes it through this pipe
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        socket.setblocking(False)
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def threads(self):
+        return (self._thread,)
+
+    def kill(self):
+        self._stop('kill')
+
+    def close(self):
+        self._stop('close')
+
+    def _stop(self, how):
+        if self._closing:
+            return
+        self._closing = how
+        self._wake()
+        self._thread.join()
+        # only now, as the loop and send may write to the pipe until here
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def send(self, meta, payload=None, fileno=None, callback=None):
+        # callbacks run on the loop thread
+        super(EventLoopClient, self).send(meta, payload, fileno, callback)
+        self._wake()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError, e:
+            # a full pipe wakes the loop just as well
+            if e.errno not in self.WOULD_BLOCK:
+                raise
+
+    def _run(self):
+        message = self._framing.new_message()
+        # (buffer or descriptor, callbacks) being written, callbacks run
+        # once it is
+        chunks = collections.deque()
+
+        try:
+            while self._closing != 'kill':
+                flushed = self._flush(chunks)
+                if self._closing == 'close' and flushed:
+                    break
+
+                readable, writable, errored = select.select([self._socket, self._wake_r],
+                                                            [] if flushed else [self._socket],
+                                                            [])
+                if self._wake_r in readable:
+                    try:
+                        os.read(self._wake_r, 4096)
+                    except OSError, e:
+                        if e.errno not in self.WOULD_BLOCK:
+                            raise
+                if self._socket in readable:
+                    message = self._receive(message)
+        except (IOError, OSError, select.error), e:
+            self._rq.put_nowait(Message.die())
+        finally:
+            # nobody may wait on a callback forever
+            for chunk, callbacks in chunks:
+                self._run_callbacks(callbacks)
+            self._sq.close()
+            self._socket.close()
+
+    def _receive(self, message):
+        """Reads until the socket would block. Returns the message that is
+        still incomplete."""
+
+        while True:
+            try:
+                message.read(self._socket)
+            except socket.error, e:
+                if e.errno in self.WOULD_BLOCK:
+                    return message
+                raise
+
+            if message.is_ready():
+                message.received_at = time.time()
+                if message.meta["type"] == "hb":
+                    self._sq.put(self._framing.frame({"type": "hb", "send_queue": self._sq.report()}) + (None, None),
+                                 control=True)
+                else:
+                    self._framing.decode(message)
+                    if message.meta["type"] == "setup":
+                        self._framing.accept(message.meta)
+                    self._rq.put(message)
+                message = self._framing.new_message()
+
+    def _flush(self, chunks):
+        """Writes until the socket would block. Returns whether everything
+        queued was written."""
+
+        while True:
+            if not chunks:
+                try:
+                    chunks.extend(self._next_chunks())
+                except Queue.Empty:
+                    return True
+
+            chunk, callbacks = chunks[0]
+            try:
+                if isinstance(chunk, int):
+                    send_fd(self._socket, chunk)
+                    rest = ''
+                else:
+                    rest = chunk[self._socket.send(chunk):]
+            except socket.error, e:
+                if e.errno in self.WOULD_BLOCK:
+                    return False
+                raise
+
+            if len(rest):
+                chunks[0] = (rest, callbacks)
+            else:
+                chunks.popleft()
+                self._run_callbacks(callbacks)
+
+    def _next_chunks(self):
+        """Takes frames off the send queue as (buffer, callbacks) to write.
+        Small frames are joined into one buffer, same as Sender does. A
+        large payload gets a buffer of its own, so it is never copied. A
+        descriptor to pass after a frame comes as its number instead of a
+        buffer. Raises Queue.Empty if there is nothing to send."""
+
+        chunks = []
+        pieces = []
+        callbacks = []
+        size = 0
+        head, payload, fileno, callback = self._sq.get_nowait()
+        while True:
+            pieces.append(head)
+            large = not (isinstance(payload, str) and len(payload) < COALESCE_MAX_PAYLOAD)
+            if large:
+                chunks.append((memoryview(''.join(pieces)), callbacks))
+                chunks.append((memoryview(payload), []))
+                pieces, callbacks = [], []
+            else:
+                pieces.append(payload)
+                size += len(head) + len(payload)
+
+            # the callback runs once the last part of its frame is written
+            if fileno is not None:
+                if pieces:
+                    chunks.append((memoryview(''.join(pieces)), callbacks))
+                    pieces, callbacks = [], []
+                chunks.append((fileno, [callback]))
+            elif large:
+                chunks[-1] = (chunks[-1][0], [callback])
+            else:
+                callbacks.append(callback)
+
+            if large or fileno is not None or size >= COALESCE_MAX_BYTES:
+                break
+            try:
+                head, payload, fileno, callback = self._sq.get_nowait()
+            except Queue.Empty:
+                break
+
+        if pieces:
+            chunks.append((memoryview(''.join(pieces)), callbacks))
+        return chunks
+
+    @staticmethod
+    def _run_callbacks(callbacks):
+        for callback in callbacks:
+            if callback:
+                callback()
@@ -0,0 +1,326 @@
+"""
+Thread slots: runs up to *size* jobs at once in this process, each on its
+own thread. This is for I/O bound jobs, like web scrapes and API calls,
+which spend their time blocked on sockets with the GIL released.
+
+The cloud client keeps the credentials of the job owner process wide, so
+only jobs of the same owner share the slots. A job of another owner waits
+until the running ones are done.
+
+What a job sends is tagged with its jid. What a job's thread prints goes
+to the boss in job_output messages tagged the same way. Output written
+straight to the file descriptors, such as by subprocesses, is not
+attributed to a job.
+
+A job is cancelled by raising JobKilled in its thread, the counterpart of
+the SIGTERM a worker running a single job gets. That is only done while
+the job runs user code, never while its finished message is sent. The
+exception is raised only once the thread runs python code again, so a job
+blocked on a socket sees it after the socket's timeout at the latest.
+"""
+
+import sys
+import time
+import ctypes
+import threading
+import collections
+import Queue
+
+import log
+import job_util
+
+# job_output messages are sent once this many bytes were printed, or once
+# OUTPUT_INTERVAL seconds passed since the previous one
+OUTPUT_CHUNK = 65536
+OUTPUT_INTERVAL = 1.0
+
+# threads of the slots themselves: the main thread, boss client and pump.
+# a job's own thread is counted in its share
+POOL_TASKS = 4
+
+class JobKilled(BaseException):
+    """Raised in a job thread to cancel the job. Like SystemExit, it is not
+    caught by except Exception."""
+
+# the output captures of the job running on the current thread
+_local = threading.local()
+
+class OutputCapture(object):
+    """Collects what a job prints to one stream, and sends it to the boss
+    in job_output messages through the job's client *c*."""
+
+    def __init__(self, c, stream):
+        self._c = c
+        self._stream = stream
+        self._pieces = []
+        self._size = 0
+        self._sent_at = time.time()
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._pieces.append(data)
+        self._size += len(data)
+        if self._size >= OUTPUT_CHUNK or time.time() - self._sent_at >= OUTPUT_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self._pieces:
+            self._c.send({'type': 'job_output', 'stream': self._stream},
+                         ''.join(self._pieces))
+            self._pieces = []
+            self._size = 0
+        self._sent_at = time.time()
+
+class OutputProxy(object):
+    """Stands in for sys.stdout or sys.stderr. Writes from a job thread go
+    to the job's capture, those from any other thread to *stream*."""
+
+    def __init__(self, name, stream):
+        self._name = name
+        self._stream = stream
+
+    def _target(self):
+        captures = getattr(_local, 'captures', None)
+        return captures[self._name] if captures else self._stream
+
+    def write(self, data):
+        self._target().write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        # fileno, isatty, encoding and the like are the stream's
+        return getattr(self._stream, name)
+
+def install_proxies():
+    """Wraps sys.stdout and sys.stderr, again after a handler replaced
+    them."""
+
+    for name in ('stdout', 'stderr'):
+        stream = getattr(sys, name)
+        if not isinstance(stream, OutputProxy):
+            setattr(sys, name, OutputProxy(name, stream))
+
+class TaggedClient(object):
+    """The client as seen by the job in a slot. Tags what the job sends
+    with its *jid*, as the jobs share the connection."""
+
+    def __init__(self, c, jid):
+        self._c = c
+        self._jid = jid
+
+    def _tag(self, meta):
+        if self._jid is None:
+            return meta
+        meta = dict(meta)
+        meta.setdefault('jid', self._jid)
+        return meta
+
+    def send(self, meta, payload=None, fileno=None, callback=None):
+        self._c.send(self._tag(meta), payload, fileno, callback)
+
+    def meta_fits(self, meta):
+        return self._c.meta_fits(self._tag(meta))
+
+    def __getattr__(self, name):
+        return getattr(self._c, name)
+
+class JobThread(threading.Thread):
+    """Runs the job of an assign or assign_batch message *m* in *slot*."""
+
+    def __init__(self, slots, slot, m):
+        threading.Thread.__init__(self, name='JobThread-%s' % slot)
+        self.daemon = True
+        self.slot = slot
+        self.m = m
+        self.jids = job_util.job_jids(m)
+        self._slots = slots
+        # jid of the job that may be killed, set by run_job, and the jids
+        # already killed
+        self._lock = threading.Lock()
+        self._killable = None
+        self._killed = set()
+
+    def run(self):
+        end_process = self._run_job()
+        self._slots._events.put((self, end_process))
+
+    def _run_job(self):
+        """Returns whether the process should be ended afterwards"""
+
+        job_util.job_local.slot = self.slot
+        job_util.job_local.killable = self.killable
+        c = TaggedClient(self._slots._c, self.m.meta.get('jid'))
+        _local.captures = {'stdout': OutputCapture(c, 'stdout'),
+                           'stderr': OutputCapture(c, 'stderr')}
+        try:
+            job_util.job_processors[self.m.meta['type']](self.m, c)
+        except job_util.EndProcessException:
+            log.logger.info('EndProcessException raised in slot %s' % self.slot)
+            return True
+        except BaseException:
+            # a job that did not get to send its finished message
+            log.logger.exception('Job %s in slot %s failed outside of run_job' % (self.jids, self.slot))
+            return True
+        finally:
+            for capture in _local.captures.values():
+                capture.flush()
+            _local.captures = None
+        return False
+
+    def killable(self, jid):
+        """Called by run_job on this thread with the *jid* of the job once it
+        may be killed, and with None once it may not"""
+
+        with self._lock:
+            self._killable = jid
+            if jid is None:
+                # a kill not raised yet would hit the finished message
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(self.ident), None)
+
+    def kill(self, jid):
+        """Raises JobKilled in the thread, if job *jid* is running user code.
+        A job is killed once, so the exception cannot hit its handling."""
+
+        with self._lock:
+            if self._killable != jid or jid in self._killed:
+                return
+            self._killed.add(jid)
+            killed = ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(self.ident),
+                                                                ctypes.py_object(JobKilled))
+            log.logger.info('Killing job %s in slot %s (%s)' % (jid, self.slot, killed))
+
+class ThreadSlots(object):
+
+    def __init__(self, c, size, message_handlers):
+        """*c* is the client connected to the boss. At most *size* jobs run
+        at once. *message_handlers* are run for control messages, same as
+        job_task's loop does."""
+
+        self._c = c
+        self._size = size
+        self._handlers = message_handlers
+        # (None for the boss, message) from the pump thread, or (job
+        # thread, whether the process should end) once a job is done
+        self._events = Queue.Queue()
+        self._pending = collections.deque()
+        self._running = []
+        # owner of the running jobs
+        self._owner = None
+        # set once no more jobs should be started
+        self._ending = False
+
+        # restrict_resources runs for each job, but the limit is shared
+        job_util.nproc_jobs = size
+        job_util.nproc_reserved = POOL_TASKS
+
+    def run(self):
+        """Runs jobs until the boss says die, or a job needs the process
+        ended. Returns once the running jobs are done."""
+
+        log.logger.info('Running up to %s jobs at once on threads' % self._size)
+
+        install_proxies()
+        self._pump()
+
+        while self._running or not self._ending:
+            source, event = self._events.get()
+            if source is None:
+                self._handle_boss_message(event)
+            else:
+                self._done(source, event)
+            self._dispatch()
+
+        # the boss can assign these elsewhere
+        jids = [jid for m in self._pending for jid in job_util.job_jids(m)]
+        if jids:
+            self._c.send({'type': 'batch_aborted',
+                          'jids': jids})
+
+    def _pump(self):
+        """Feeds messages from the boss into the event queue."""
+
+        def pump():
+            while True:
+                m = self._c.read()
+                self._events.put((None, m))
+                if m.meta['type'] == 'die':
+                    break
+
+        th = threading.Thread(target=pump, name='ThreadSlotsPump')
+        th.daemon = True
+        th.start()
+        job_util.worker_threads.append(th)
+
+    def _handle_boss_message(self, m):
+        if m.meta['type'] in job_util.job_processors:
+            log.logger.info('Queueing %s' % job_util.job_jids(m))
+            self._pending.append(m)
+            return
+
+        if m.meta['type'] == 'die':
+            log.logger.info('Received message to die.')
+            self._ending = True
+        elif m.meta['type'] == 'cancel':
+            self._cancel(m.meta['jid'])
+            return
+
+        handler = self._handlers.get(m.meta['type'])
+        if handler:
+            log.logger.info('Handling message %s m.meta' % m.meta)
+            handler(m)
+            install_proxies()
+        else:
+            log.logger.info('Unrecognized message type %s' % m.meta['type'])
+
+    def _cancel(self, jid):
+        for th in self._running:
+            if jid in th.jids:
+                th.kill(jid)
+                return
+
+        for m in self._pending:
+            if jid in job_util.job_jids(m):
+                # not started yet, so nothing was lost
+                self._pending.remove(m)
+                self._c.send({'type': 'batch_aborted',
+                              'jids': job_util.job_jids(m)})
+                return
+
+    def _done(self, th, end_process):
+        th.join()
+        self._running.remove(th)
+        if end_process:
+            self._ending = True
+
+        if not self._running:
+            self._owner = None
+            # what run_job does after every job when jobs run one at a time
+            import scicloud as cloud
+            job_util.close_cloud(cloud)
+            if not self._ending and job_util.user_threads_running(self._c):
+                self._ending = True
+
+    def _dispatch(self):
+        """Starts pending jobs in free slots, in order, as long as they
+        have the owner of the running ones."""
+
+        while self._pending and not self._ending and len(self._running) < self._size:
+            m = self._pending[0]
+            if self._running and job_util.job_owner(m) != self._owner:
+                return
+            self._pending.popleft()
+            self._owner = job_util.job_owner(m)
+
+            taken = set(th.slot for th in self._running)
+            slot = min(set(range(self._size)) - taken)
+            th = JobThread(self, slot, m)
+            self._running.append(th)
+            log.logger.info('Starting %s in slot %s' % (th.jids, slot))
+            th.start()
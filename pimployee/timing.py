@@ -0,0 +1,81 @@
+"""
+Latency breakdown of the job hot path. A PhaseTimer splits the time from
+an assign message arriving to its finished message being queued into
+phases. Each job reports its own phases, and every phase also feeds a
+histogram kept for the lifetime of the worker.
+
+Nothing is timed unless *enabled* is set, from the setup message.
+"""
+
+import time
+import bisect
+
+enabled = False
+
+class Histogram(object):
+    """Latency histogram with logarithmic buckets, four per doubling, from
+    1 microsecond to about 20 minutes. Quantiles are accurate to ~20%."""
+
+    BOUNDS = [1e-6 * 2 ** (i / 4.0) for i in range(121)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the *q* quantile"""
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                break
+        if i < len(self.BOUNDS):
+            return min(self.BOUNDS[i], self.max)
+        return self.max
+
+    def report(self):
+        return {'count': self.count,
+                'p50': self.quantile(0.5),
+                'p99': self.quantile(0.99),
+                'max': self.max}
+
+# phase -> Histogram, over every job this worker ran
+lifetime = {}
+
+def record(phase, seconds):
+    if phase not in lifetime:
+        lifetime[phase] = Histogram()
+    lifetime[phase].add(seconds)
+
+def lifetime_report():
+    return dict((phase, histogram.report()) for phase, histogram in lifetime.items())
+
+class PhaseTimer(object):
+    """Times the phases of one job. Each mark() ends a phase, which took
+    the time since the previous mark(), or since *start*."""
+
+    def __init__(self, start=None):
+        self.phases = {}
+        if enabled:
+            self._last = start or time.time()
+
+    def mark(self, phase):
+        if not enabled:
+            return
+        now = time.time()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def finish(self):
+        """Adds the phases to the lifetime histograms"""
+
+        for phase, seconds in self.phases.items():
+            record(phase, seconds)
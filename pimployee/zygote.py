@@ -0,0 +1,380 @@
+"""
+Zygote mode runs several jobs at once in one worker.
+
+The process that job_task set up (sys.path, cloud config, warm imports)
+becomes a zygote. It forks a child per job slot and from then on only routes
+messages: assignments from the boss go to an idle child over a socketpair,
+and everything a child sends back is forwarded to the boss tagged with the
+jid the child is running. Children share the zygote's memory copy-on-write.
+A child that ends is reaped, and a fresh one is forked from the zygote when
+it is needed.
+
+A cancel message from the boss sends SIGTERM to the child running the job,
+as the boss would to a worker running a single job. Children get SIGTERM
+too once the zygote is gone.
+"""
+
+import os
+import sys
+import ctypes
+import signal
+import socket
+import threading
+import functools
+import collections
+import Queue
+
+import log
+import job_util
+from switchboard_client import UnixDomainSocketClient, PROTOCOL_BINARY
+
+# control messages only the zygote handles. modules preloaded there are
+# shared by every child forked later
+ZYGOTE_ONLY = ('preload',)
+
+# framing of the socketpairs to the children. the legacy framing limits a
+# meta to 1kB, which a large assign_batch does not fit in
+PAIR_SETUP = {'protocol': PROTOCOL_BINARY}
+
+# messages of a child read ahead of the one being forwarded. while the boss
+# link is backed up, a child blocks on its own send queue rather than the
+# zygote taking in all it sends
+CHILD_READ_AHEAD = 1
+
+# processes and threads of the pool itself: the zygote's main thread, boss
+# client and pump, and per child its main thread and client plus the
+# client and pump the zygote keeps for it
+POOL_TASKS = 4
+CHILD_TASKS = 6
+
+PR_SET_PDEATHSIG = 1
+
+def _send(client, m, callback=None):
+    """Passes *m* on through *client*, along with the descriptor that came
+    with it, if any."""
+
+    if m.meta.get('has_fd'):
+        client.send(m.meta, m.payload or None, fileno=m.meta['fileno'], callback=callback)
+    else:
+        client.send(m.meta, m.payload or None)
+
+def _send_copy(client, m):
+    """Passes *m* on through *client* with a duplicate of the descriptor that
+    came with it, closed once passed on. The zygote keeps its own."""
+
+    copy = os.dup(m.meta['fileno'])
+    client.send(m.meta, m.payload or None, fileno=copy,
+                callback=functools.partial(os.close, copy))
+
+def _closer(m, copies):
+    """Returns a callback that closes the zygote's copy of the descriptor
+    that came with *m* once *copies* of it were passed on, or None if none
+    came. Only for descriptors the zygote does not keep."""
+
+    if not m.meta.get('has_fd'):
+        return None
+    fileno = m.meta['fileno']
+    if not copies:
+        os.close(fileno)
+        return None
+
+    left = [copies]
+    lock = threading.Lock()
+    def close():
+        with lock:
+            left[0] -= 1
+            if not left[0]:
+                os.close(fileno)
+    return close
+
+class Child(object):
+    """A forked child, as seen from the zygote."""
+
+    def __init__(self, pid, sock, client):
+        self.pid = pid
+        self.sock = sock
+        self.client = client
+        # released as each message of the child is forwarded
+        self.forwarded = threading.Semaphore(0)
+        self.assign(None)
+
+    def assign(self, job):
+        """Notes that the child was handed *job*, an assign or assign_batch
+        message, or that it is idle if *job* is None."""
+
+        self.job = job
+        # jids the child has not sent finished for, and those it started
+        if job is None:
+            self.unfinished = []
+        elif job.meta['type'] == 'assign_batch':
+            self.unfinished = [batch_job['jid'] for batch_job in job.meta['jobs']]
+        else:
+            self.unfinished = [job.meta['jid']]
+        self.started = set()
+        # whether the job was cancelled, so it is not handed out again
+        self.cancelled = False
+
+    @property
+    def jid(self):
+        """The jid of a single job, which the child does not tag its own
+        messages with."""
+
+        if self.job and self.job.meta['type'] == 'assign':
+            return self.job.meta['jid']
+
+
+class ZygotePool(object):
+
+    def __init__(self, c, size, message_handlers):
+        """*c* is the client connected to the boss. At most *size* children
+        are forked. *message_handlers* are run in the zygote and in every
+        child for control messages, same as job_task's loop does."""
+
+        self._c = c
+        # read now, as the boss socket is closed in every child
+        self._passes_fds = c.passes_fds
+        self._size = size
+        self._handlers = message_handlers
+        # (child or None for the boss, message) from the pump threads
+        self._events = Queue.Queue()
+        self._children = []
+        self._pending = collections.deque()
+
+        # restrict_resources runs in each child, but the limit is shared
+        job_util.nproc_jobs = size
+        job_util.nproc_reserved = POOL_TASKS + CHILD_TASKS * size
+
+    def run(self):
+        """Routes messages until the boss says die."""
+
+        log.logger.info('Running as zygote with up to %s children' % self._size)
+
+        self._pump(None, self._c)
+
+        while True:
+            child, m = self._events.get()
+            if child is None:
+                if m.meta['type'] == 'die':
+                    log.logger.info('Received message to die.')
+                    break
+                self._handle_boss_message(m)
+            elif m.meta['type'] == 'die':
+                self._reap(child)
+            else:
+                self._forward(child, m)
+                child.forwarded.release()
+
+        self._shutdown()
+
+    def _pump(self, child, client):
+        """Feeds messages read from *client* into the event queue."""
+
+        def pump():
+            while True:
+                m = client.read()
+                self._events.put((child, m))
+                if m.meta['type'] == 'die':
+                    break
+                if child is not None:
+                    # the socket is only read on once there is room
+                    child.forwarded.acquire()
+
+        th = threading.Thread(target=pump)
+        th.daemon = True
+        th.start()
+
+    def _handle_boss_message(self, m):
+        if m.meta['type'] in job_util.job_processors:
+            log.logger.info('Queueing %s' % m.meta.get('jid', 'batch'))
+            self._pending.append(m)
+            self._dispatch()
+            return
+        elif m.meta['type'] == 'cancel':
+            self._cancel(m.meta['jid'])
+            return
+
+        handler = self._handlers.get(m.meta['type'])
+        if handler:
+            # children forked later inherit what the handler set up here
+            log.logger.info('Handling message %s m.meta' % m.meta)
+            handler(m)
+        else:
+            log.logger.info('Unrecognized message type %s' % m.meta['type'])
+
+        if m.meta['type'] in ZYGOTE_ONLY:
+            return
+        if handler and m.meta.get('has_fd'):
+            # the handler kept the descriptor, as sys.stdout or a log file
+            # children forked later inherit, so each child is passed a
+            # duplicate, closed once passed on
+            for child in self._children:
+                _send_copy(child.client, m)
+        else:
+            # every child gets a copy of a descriptor the boss passed
+            close = _closer(m, len(self._children))
+            for child in self._children:
+                _send(child.client, m, close)
+
+    def _cancel(self, jid):
+        for child in self._children:
+            if jid not in child.unfinished:
+                continue
+            if child.started and jid not in child.started:
+                # the child reads nothing until its batch is done
+                log.logger.info('Cannot cancel %s, queued in the batch of child %s' % (jid, child.pid))
+            else:
+                # _reap reports the jobs once the child is gone
+                log.logger.info('Killing child %s running %s' % (child.pid, jid))
+                child.cancelled = True
+                os.kill(child.pid, signal.SIGTERM)
+            return
+
+        for m in self._pending:
+            jids = job_util.job_jids(m)
+            if jid in jids:
+                # not started yet, so nothing was lost
+                self._pending.remove(m)
+                _closer(m, 0)
+                self._c.send({'type': 'batch_aborted',
+                              'jids': jids})
+                return
+
+    def _dispatch(self):
+        """Hands pending jobs to idle children, forking new ones while under
+        the limit."""
+
+        while self._pending:
+            idle = [child for child in self._children if child.job is None]
+            if idle:
+                child = idle[0]
+            elif len(self._children) < self._size:
+                child = self._spawn()
+            else:
+                return
+
+            child.assign(self._pending.popleft())
+            log.logger.info('Dispatching %s to child %s' % (child.unfinished, child.pid))
+            if child.job.meta.get('has_fd'):
+                # kept until the job is done, as it is handed out again if
+                # the child ends before starting it
+                _send_copy(child.client, child.job)
+            else:
+                _send(child.client, child.job)
+
+    def _forward(self, child, m):
+        """Forwards a message from *child* to the boss, tagged with its jid."""
+
+        # the length is framing detail of the socketpair, not the boss link
+        m.meta.pop('payload_length', None)
+        if child.jid is not None:
+            m.meta.setdefault('jid', child.jid)
+        _send(self._c, m, _closer(m, 1))
+
+        if m.meta['type'] == 'processing':
+            child.started.add(m.meta['jid'])
+        elif m.meta['type'] == 'finished':
+            child.unfinished.remove(m.meta['jid'])
+        elif m.meta['type'] == 'batch_aborted':
+            for jid in m.meta['jids']:
+                child.unfinished.remove(jid)
+
+        if child.job and not child.unfinished:
+            _closer(child.job, 0)
+            child.assign(None)
+            self._dispatch()
+
+    def _reap(self, child):
+        pid, status = os.waitpid(child.pid, 0)
+        log.logger.info('Child %s ended with status %s' % (pid, status))
+
+        self._children.remove(child)
+        child.sock.close()
+
+        if child.job and not child.started and not child.cancelled:
+            # the child ended before it began the job, so nothing was lost
+            self._pending.appendleft(child.job)
+        elif child.job:
+            _closer(child.job, 0)
+            for jid in child.unfinished:
+                if jid in child.started:
+                    self._c.send({'type': 'finished',
+                                  'jid': jid,
+                                  'runtime': 0.0,
+                                  'traceback': True},
+                                 'Worker process %s ended while running job (status %s)' % (pid, status))
+            not_started = [jid for jid in child.unfinished if jid not in child.started]
+            if not_started:
+                self._c.send({'type': 'batch_aborted',
+                              'jids': not_started})
+
+        self._dispatch()
+
+    def _spawn(self):
+        parent_sock, child_sock = socket.socketpair()
+
+        zygote_pid = os.getpid()
+        pid = os.fork()
+        if pid == 0:
+            # ended along with the zygote rather than left behind. the
+            # zygote may have gone before the signal was asked for
+            ctypes.CDLL(None).prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+            if os.getppid() != zygote_pid:
+                os._exit(1)
+            # the boss socket was already closed by its atfork hook
+            parent_sock.close()
+            for child in self._children:
+                child.sock.close()
+            self._child_main(child_sock)
+
+        child_sock.close()
+        child = Child(pid, parent_sock, UnixDomainSocketClient(parent_sock, PAIR_SETUP, CHILD_READ_AHEAD))
+        self._children.append(child)
+        self._pump(child, child.client)
+
+        log.logger.info('Forked child %s' % pid)
+        return child
+
+    def _child_main(self, sock):
+        """Runs jobs handed over by the zygote. Never returns."""
+
+        status = 0
+        try:
+            client = UnixDomainSocketClient(sock, PAIR_SETUP)
+            client.send_queue.limit = self._c.send_queue.limit
+            if not self._passes_fds:
+                # the socketpair carries descriptors, but the zygote could
+                # not pass a result's on to the boss
+                job_util.shm_result_threshold = None
+
+            while True:
+                m = client.read()
+                handler = self._handlers.get(m.meta['type'])
+                if handler:
+                    handler(m)
+
+                if m.meta['type'] in job_util.job_processors:
+                    try:
+                        job_util.job_processors[m.meta['type']](m, client)
+                    except job_util.EndProcessException:
+                        log.logger.info('EndProcessException raised. Child will end')
+                        break
+
+                if m.meta['type'] == 'die':
+                    break
+
+            client.close()
+        except BaseException:
+            log.logger.exception('Zygote child hit exception')
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            # skip the zygote's atexit handlers and finally blocks
+            os._exit(status)
+
+    def _shutdown(self):
+        for child in self._children:
+            child.client.send({'type': 'die'})
+        for child in self._children:
+            os.waitpid(child.pid, 0)
+        self._children = []
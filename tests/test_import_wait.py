@@ -0,0 +1,85 @@
+"""
+Unpickles functions of modules that are created while job_util.deserialize
+waits for them, the way a push to ap_path lands while a job starts.
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pimployee import log, job_util, import_wait
+
+def create_later(path, source, delay):
+    """Writes *source* to *path* after *delay* seconds, renamed into place
+    so that it is never imported half written"""
+
+    def create():
+        time.sleep(delay)
+        with open(path + '.tmp', 'w') as f:
+            f.write(source)
+        os.rename(path + '.tmp', path)
+
+    th = threading.Thread(target=create)
+    th.start()
+    return th
+
+class ImportWaitTest(unittest.TestCase):
+
+    def setUp(self):
+        if log.logger is None:
+            log.logger = logging.Logger('test')
+            log.logger.addHandler(logging.NullHandler())
+        self.dir = tempfile.mkdtemp()
+        sys.path.insert(0, self.dir)
+        # a package that exists, and whose module is pushed later
+        os.mkdir(os.path.join(self.dir, 'waitpkg'))
+        open(os.path.join(self.dir, 'waitpkg', '__init__.py'), 'w').close()
+
+    def tearDown(self):
+        sys.path.remove(self.dir)
+        for name in list(sys.modules):
+            if name.split('.')[0] in ('waitpkg', 'waitmod'):
+                del sys.modules[name]
+        shutil.rmtree(self.dir)
+
+    def test_missing_module(self):
+        import waitpkg
+        pickled = 'cwaitpkg.newmod\nf\np0\n.'
+        try:
+            import waitpkg.newmod
+        except ImportError, e:
+            # python 2 names only the part it did not find
+            self.assertEqual(import_wait.missing_module(e), 'newmod')
+            self.assertEqual(import_wait.missing_module(e, pickled), 'waitpkg.newmod')
+        else:
+            self.fail('waitpkg.newmod should not exist yet')
+
+    def wait_for(self, path, pickled):
+        th = create_later(os.path.join(self.dir, path), 'def f():\n    return 42\n', 0.3)
+        start = time.time()
+        try:
+            f = job_util.deserialize(pickled)
+        finally:
+            th.join()
+        self.assertEqual(f(), 42)
+        # seen as the directory changed, well ahead of the deadline
+        self.assertTrue(time.time() - start < 1.0)
+
+    def test_top_level_module(self):
+        self.wait_for('waitmod.py', 'cwaitmod\nf\np0\n.')
+
+    def test_module_in_existing_package(self):
+        import waitpkg
+        self.wait_for(os.path.join('waitpkg', 'newmod.py'), 'cwaitpkg.newmod\nf\np0\n.')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+"""
+Reads local files through PrefetchingReader, opened with local_getf as a
+filemap mapper's file would be, and checks what comes out against reading
+the same bytes from a StringIO.
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import random
+import logging
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pimployee import log, job_util
+from pimployee.prefetch import PrefetchingReader, local_getf
+
+def make_data(rnd, size):
+    """Lines of random length, some empty, without a final newline"""
+
+    pieces = []
+    while sum(map(len, pieces)) < size:
+        pieces.append('x' * rnd.choice([0, 1, 2, 5, 17, 100, 3000]) + '\n')
+    return ''.join(pieces)[:size]
+
+def line_reader(fobj, end_byte):
+    """A filemap record reader that yields lines starting before *end_byte*"""
+
+    position = fobj.tell()
+    for line in fobj:
+        if position >= end_byte:
+            break
+        position += len(line)
+        yield line
+
+def line_lengths(line):
+    yield len(line)
+
+def total(lengths):
+    yield sum(lengths)
+
+class PrefetchingReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rnd = random.Random(1234)
+        self.data = make_data(self.rnd, 100000)
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_random_reads(self):
+        for block_size in (3, 4096, 65536, 1048576):
+            for start in (0, 1, 12345):
+                expected = StringIO(self.data)
+                expected.seek(start)
+                reader = PrefetchingReader(local_getf(self.path, start, len(self.data)),
+                                           block_size, depth=2)
+                while True:
+                    size = self.rnd.choice([-1, 0, 1, 3, 100, 5000, 70000])
+                    if self.rnd.random() < 0.5:
+                        got, want = reader.readline(size), expected.readline(size)
+                    else:
+                        got, want = reader.read(size), expected.read(size)
+                    self.assertEqual(got, want)
+                    self.assertEqual(reader.tell(), expected.tell())
+                    if not want and size:
+                        break
+                self.assertEqual(reader.read(), '')
+                reader.close()
+
+    def test_lines(self):
+        reader = PrefetchingReader(local_getf(self.path, 0, len(self.data)), 4096)
+        self.assertEqual(list(reader), StringIO(self.data).readlines())
+        reader.close()
+
+    def test_mapper(self):
+        if log.logger is None:
+            log.logger = logging.Logger('test')
+            log.logger.addHandler(logging.NullHandler())
+        job_util.job_local.stats = {}
+
+        end_byte = len(self.data) // 2
+        results = []
+        for prefetch in (None, (4096, 4)):
+            inner = job_util.mapper_combiner_generator(line_lengths, self.path, len(self.data),
+                                                       line_reader, total, prefetch=prefetch,
+                                                       getf=local_getf)
+            results.append(inner(0, end_byte))
+
+        self.assertEqual(results[0], results[1])
+        self.assertTrue(results[0][0] >= end_byte)
+        self.assertEqual(job_util.job_local.stats['prefetch']['block_size'], 4096)
+
+if __name__ == '__main__':
+    unittest.main()
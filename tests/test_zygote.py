@@ -0,0 +1,160 @@
+"""
+Runs a zygote against a fake boss on a unix domain socket, connected to the
+way job_task does. The jobs themselves are stood in for, so only the
+routing is exercised.
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import logging
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# as job_task does, so the boss socket is closed in forked children
+import atfork
+atfork.monkeypatch_os_fork_functions()
+
+from pimployee import log, setup_util, job_util, zygote, shm
+from pimployee.switchboard_client import UnixDomainSocketClient, PROTOCOL_BINARY
+
+def fake_batch(m, c):
+    for job in m.meta['jobs']:
+        c.send({'type': 'processing', 'jid': job['jid']})
+        c.send({'type': 'finished', 'jid': job['jid'], 'runtime': 0.0}, str(os.getpid()))
+
+def fake_forever(m, c):
+    c.send({'type': 'processing'})
+    while True:
+        time.sleep(0.01)
+
+# fake_crash_once ends the child unless this file exists, then creates it
+crash_marker = None
+
+def fake_crash_once(m, c):
+    if not os.path.exists(crash_marker):
+        open(crash_marker, 'w').close()
+        os._exit(1)
+    c.send({'type': 'processing'})
+    c.send({'type': 'finished', 'runtime': 0.0}, str(m.payload_parts()[0]))
+
+class ZygoteTest(unittest.TestCase):
+
+    def setUp(self):
+        if log.logger is None:
+            log.logger = logging.Logger('test')
+            log.logger.addHandler(logging.NullHandler())
+        self.processors = dict(job_util.job_processors)
+        job_util.job_processors['assign_batch'] = fake_batch
+        job_util.job_processors['assign'] = fake_forever
+
+        # the boss link as after a setup that accepted protocol 2
+        setup = {'protocol': PROTOCOL_BINARY}
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'boss.sock')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(1)
+        worker_sock = setup_util.connect_to_boss(path)
+        boss_sock, _ = listener.accept()
+        listener.close()
+        self.boss = UnixDomainSocketClient(boss_sock, setup)
+        # a test that waits on the boss link for too long fails rather
+        # than hangs, as the boss sees the link die
+        self.watchdog = threading.Timer(30, boss_sock.shutdown, [socket.SHUT_RDWR])
+        self.watchdog.daemon = True
+        self.watchdog.start()
+        worker = UnixDomainSocketClient(worker_sock, setup)
+        pool = zygote.ZygotePool(worker, 2, {})
+
+        def run():
+            try:
+                pool.run()
+            finally:
+                # the boss sees a worker that failed as a closed socket
+                worker_sock.shutdown(socket.SHUT_RDWR)
+
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.watchdog.cancel()
+        self.boss.send({'type': 'die'})
+        self.thread.join()
+        job_util.job_processors.clear()
+        job_util.job_processors.update(self.processors)
+        shutil.rmtree(self.dir)
+
+    def test_large_batch(self):
+        # far more than the 1kB legacy meta holds
+        jids = range(1000, 1200)
+        jobs = [{'jid': jid, 'func': 'f', 'args': 'a'} for jid in jids]
+        self.boss.send({'type': 'assign_batch', 'jobs': jobs}, '')
+
+        finished = {}
+        while len(finished) < len(jids):
+            m = self.boss.read()
+            self.assertNotEqual(m.meta['type'], 'die')
+            if m.meta['type'] == 'finished':
+                finished[m.meta['jid']] = str(m.payload)
+
+        self.assertEqual(sorted(finished), jids)
+        # run by a forked child, not the zygote itself
+        self.assertEqual(len(set(finished.values())), 1)
+        self.assertNotEqual(finished.values()[0], str(os.getpid()))
+
+    def test_cancel(self):
+        for jid in (1, 2, 3):
+            self.boss.send({'type': 'assign', 'jid': jid}, '')
+        started = set()
+        while len(started) < 2:
+            m = self.boss.read()
+            self.assertNotEqual(m.meta['type'], 'die')
+            if m.meta['type'] == 'processing':
+                started.add(m.meta['jid'])
+        self.assertEqual(started, set([1, 2]))
+
+        # 3 waits for a free child, the others are killed
+        for jid in (3, 1, 2):
+            self.boss.send({'type': 'cancel', 'jid': jid})
+
+        ended = {}
+        while len(ended) < 3:
+            m = self.boss.read()
+            self.assertNotEqual(m.meta['type'], 'die')
+            if m.meta['type'] == 'batch_aborted':
+                ended.update((jid, 'aborted') for jid in m.meta['jids'])
+            elif m.meta['type'] == 'finished':
+                ended[m.meta['jid']] = 'traceback' if m.meta.get('traceback') else 'result'
+        self.assertEqual(ended, {1: 'traceback', 2: 'traceback', 3: 'aborted'})
+
+    def test_payload_fd_handed_out_again(self):
+        global crash_marker
+        crash_marker = os.path.join(self.dir, 'crashed')
+        job_util.job_processors['assign'] = fake_crash_once
+
+        # the first child ends before it starts the job, so the second one
+        # is passed the same descriptor
+        fd = shm.write('payload', 'the payload')
+        self.boss.send({'type': 'assign', 'jid': 7, 'payload_fd': True},
+                       fileno=fd, callback=lambda: os.close(fd))
+
+        while True:
+            m = self.boss.read()
+            self.assertNotEqual(m.meta['type'], 'die')
+            if m.meta['type'] == 'finished':
+                break
+        self.assertEqual(m.meta['jid'], 7)
+        self.assertEqual(str(m.payload), 'the payload')
+        self.assertTrue(os.path.exists(crash_marker))
+
+if __name__ == '__main__':
+    unittest.main()